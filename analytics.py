@@ -0,0 +1,48 @@
+# analytics.py - ДНЕВНЫЕ СВОДКИ
+"""Фоновое обновление дневных сводок (daily_model_stats, daily_user_stats).
+
+Сводки не пересчитываются по всей истории: Database.rollup_stats берёт
+пачку строк images/transactions после сохранённой водяной отметки.
+После перезапуска задача догоняет с того же места. Пачки ограничены
+по размеру, между ними поток-писатель успевает выполнить записи апдейтов.
+"""
+import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class StatsRollup:
+    def __init__(self, db, interval: float = 60.0, batch_size: int = 5000):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self) -> int:
+        """Догнать водяную отметку; возвращает число обработанных строк"""
+        total = 0
+        while True:
+            processed = await self.db.rollup_stats(self.batch_size)
+            total += processed
+            # Неполная пачка - учтено всё, что было записано к этому моменту
+            if processed < self.batch_size:
+                return total
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"❌ Günlük özet görevi hatası: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="stats-rollup")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
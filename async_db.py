@@ -0,0 +1,423 @@
+# async_db.py - АСИНХРОННЫЙ ДОСТУП К БАЗЕ
+import asyncio
+import csv
+import functools
+import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, List, Iterable, Iterator, Tuple, TypeVar
+
+import metrics
+from tracing import tracer, SQLITE
+from cache import LRUCache
+from database import Database, demo_balance
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Режимы надёжности для записей через групповой коммит
+DURABLE = "durable"      # ждать, пока пачка будет закоммичена
+BUFFERED = "buffered"    # вернуть управление сразу, коммит - позже
+IMMEDIATE = "immediate"  # отдельный коммит, мимо буфера
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database.
+
+    Все записи идут через один поток-писатель (одно соединение, WAL),
+    чтения - через небольшой пул read-only соединений. Event loop
+    больше не ждёт fsync: обработчики просто делают await.
+
+    Транзакции и записи об изображениях копятся в буфере и пишутся
+    одним executemany-коммитом, когда набралось batch_size строк или
+    прошло flush_interval секунд. Подтверждение резерва едет в той же
+    пачке, что и запись об изображении.
+
+    Профили пользователей (и баланс) кэшируются в LRU users_cache.
+    Кэш обновляется сквозной записью: после каждой записи, меняющей
+    пользователя, писатель перечитывает его строку тем же соединением.
+    Записи других процессов (cluster.py) кэш не видит - для них cache_ttl
+    ограничивает, сколько живёт прочитанная строка.
+    """
+
+    def __init__(self, db_name: str = "bot.db", readers: int = 4,
+                 batch_size: int = 100, flush_interval: float = 0.02,
+                 cache_size: int = 10000, cache_ttl: Optional[float] = None):
+        self.db_name = db_name
+        self.users_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        # Растёт при каждой сквозной записи; чтение, начатое до неё,
+        # не должно класть в кэш устаревшую строку
+        self._cache_epoch = 0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending_transactions: List[tuple] = []
+        self._pending_images: List[tuple] = []
+        self._pending_commits: List[Tuple[int, str]] = []
+        self._pending_waiters: List[asyncio.Future] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._writer: Optional[Database] = None
+        self._readers: "queue.Queue[Database]" = queue.Queue()
+        self._writer_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="db-writer"
+        )
+        self._reader_executor = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="db-reader"
+        )
+
+    # ========== ВНУТРЕННЕЕ ==========
+    def _call_writer(self, method: str, args: tuple, kwargs: dict):
+        """Выполняется только в потоке-писателе"""
+        if self._writer is None:
+            self._writer = Database(self.db_name)
+        return getattr(self._writer, method)(*args, **kwargs)
+
+    def _call_writer_fetch(self, method: str, args: tuple, kwargs: dict,
+                           user_ids: List[int]):
+        """Запись + перечитывание затронутых пользователей (поток-писатель)"""
+        result = self._call_writer(method, args, kwargs)
+        return result, self._writer.get_user_profiles(user_ids)
+
+    def _call_reader(self, method: str, args: tuple, kwargs: dict):
+        """Выполняется в одном из потоков-читателей"""
+        try:
+            reader = self._readers.get_nowait()
+        except queue.Empty:
+            # Соединений не больше, чем потоков в пуле
+            reader = Database(self.db_name, read_only=True)
+        try:
+            return getattr(reader, method)(*args, **kwargs)
+        finally:
+            self._readers.put(reader)
+
+    async def _write(self, method: str, *args, **kwargs):
+        return await self._run(
+            self._writer_executor, method,
+            functools.partial(self._call_writer, method, args, kwargs)
+        )
+
+    async def _run(self, executor: ThreadPoolExecutor, method: str, call):
+        """Выполнить вызов в пуле потоков и записать время в метрики"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            with tracer.span(SQLITE):
+                return await loop.run_in_executor(executor, call)
+        except Exception:
+            metrics.DB_ERRORS.inc(method)
+            raise
+        finally:
+            metrics.DB_LATENCY.observe(time.perf_counter() - started, method)
+
+    async def _write_through(self, method: str, user_ids: Iterable[int],
+                             *args, **kwargs):
+        """Запись, после которой кэш пользователей обновляется свежими строками"""
+        user_ids = list(set(user_ids))
+        try:
+            result, profiles = await self._run(
+                self._writer_executor, method,
+                functools.partial(self._call_writer_fetch, method, args,
+                                  kwargs, user_ids)
+            )
+        except Exception:
+            self._invalidate(user_ids)
+            raise
+
+        self._cache_epoch += 1
+        for profile in profiles:
+            self.users_cache.put(profile["user_id"], profile)
+        return result
+
+    def _invalidate(self, user_ids: Iterable[int]):
+        """Забыть профили; чтения, начатые раньше, не вернут их в кэш"""
+        self._cache_epoch += 1
+        for user_id in user_ids:
+            self.users_cache.pop(user_id)
+
+    # ========== ГРУППОВОЙ КОММИТ ==========
+    @property
+    def pending_writes(self) -> int:
+        """Строк в буфере группового коммита"""
+        return (len(self._pending_transactions) + len(self._pending_images)
+                + len(self._pending_commits))
+
+    async def _enqueue(self, transaction: Optional[tuple] = None,
+                       image: Optional[tuple] = None,
+                       commit: Optional[Tuple[int, str]] = None,
+                       durability: str = DURABLE) -> bool:
+        """Положить строку в буфер и (для DURABLE) дождаться коммита пачки"""
+        if durability == IMMEDIATE:
+            return await self._write_through(
+                "write_batch",
+                [row[0] for row in (transaction, commit) if row],
+                [transaction] if transaction else [],
+                [image] if image else [],
+                [commit] if commit else []
+            )
+
+        loop = asyncio.get_running_loop()
+        if transaction:
+            self._pending_transactions.append(transaction)
+        if image:
+            self._pending_images.append(image)
+        if commit:
+            self._pending_commits.append(commit)
+
+        waiter = None
+        if durability == DURABLE:
+            waiter = loop.create_future()
+            self._pending_waiters.append(waiter)
+
+        if self.pending_writes >= self.batch_size:
+            self._schedule_flush(0)
+        elif self._flush_handle is None:
+            self._schedule_flush(self.flush_interval)
+
+        return await waiter if waiter else True
+
+    def _schedule_flush(self, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(
+            delay, lambda: loop.create_task(self.flush())
+        )
+
+    async def flush(self) -> bool:
+        """Записать всё, что накопилось в буфере"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        transactions, self._pending_transactions = self._pending_transactions, []
+        images, self._pending_images = self._pending_images, []
+        commits, self._pending_commits = self._pending_commits, []
+        waiters, self._pending_waiters = self._pending_waiters, []
+        if not transactions and not images and not commits:
+            return True
+
+        try:
+            ok = await self._write_through(
+                "write_batch",
+                [row[0] for row in transactions] + [user_id for user_id, _ in commits],
+                transactions, images, commits
+            )
+        except Exception as e:
+            logger.error(f"❌ Toplu kayıt başarısız: {e}")
+            ok = False
+
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(ok)
+        return ok
+
+    async def _read(self, method: str, *args, **kwargs):
+        if self._writer is None:
+            # Файл базы и схему создаёт писатель - до первого чтения
+            await self._write("create_tables")
+        return await self._run(
+            self._reader_executor, method,
+            functools.partial(self._call_reader, method, args, kwargs)
+        )
+
+    # ========== ПОЛЬЗОВАТЕЛИ ==========
+    async def add_user(self, user_id: int, username: str, first_name: str,
+                       last_name: str, invited_by: Optional[int] = None) -> bool:
+        # Пригласивший получает бонус в той же транзакции - обновляем и его
+        user_ids = [user_id] if invited_by is None else [user_id, invited_by]
+        return await self._write_through("add_user", user_ids, user_id,
+                                         username, first_name, last_name,
+                                         invited_by)
+
+    async def get_user_profile(self, user_id: int) -> Optional[dict]:
+        profile = self.users_cache.get(user_id)
+        if profile is not None:
+            return profile
+
+        epoch = self._cache_epoch
+        profile = await self._read("get_user_profile", user_id)
+        if profile is not None and epoch == self._cache_epoch:
+            self.users_cache.put(user_id, profile)
+        return profile
+
+    async def get_user_tokens(self, user_id: int) -> int:
+        profile = await self.get_user_profile(user_id)
+        return demo_balance(profile["tokens"] if profile else None)
+
+    # ========== ТОКЕНЫ ==========
+    async def add_tokens(self, user_id: int, amount: int, action: str,
+                         details: str = "", durability: str = DURABLE) -> bool:
+        logger.info(f"📝 Token işlemi: {user_id} -> {amount} ({action})")
+        return await self._enqueue(
+            transaction=(user_id, action, amount, details),
+            durability=durability
+        )
+
+    async def reserve_tokens(self, user_id: int, amount: int, idempotency_key: str,
+                             action: str, details: str = "") -> Tuple[str, int]:
+        return await self._write_through("reserve_tokens", [user_id], user_id,
+                                         amount, idempotency_key, action, details)
+
+    async def commit_reservation(self, user_id: int, idempotency_key: str) -> bool:
+        return await self._write_through("commit_reservation", [user_id],
+                                         user_id, idempotency_key)
+
+    async def refund_reservation(self, user_id: int, idempotency_key: str,
+                                 details: str = "") -> bool:
+        if (user_id, idempotency_key) in self._pending_commits:
+            # Изображение уже доставлено, подтверждение ждёт коммита пачки
+            return False
+        return await self._write_through("refund_reservation", [user_id],
+                                         user_id, idempotency_key, details)
+
+    async def refund_stale_reservations(self, max_age: float) -> List[int]:
+        user_ids = await self._write("refund_stale_reservations", max_age)
+        # Балансы изменились - перечитаются при следующем обращении
+        self._invalidate(user_ids)
+        return user_ids
+
+    # ========== ИСТОРИЯ ==========
+    async def get_user_history(self, user_id: int, limit: int = 5) -> List[dict]:
+        return await self._read("get_user_history", user_id, limit)
+
+    async def get_referral_leaderboard(self, limit: int = 10) -> List[dict]:
+        return await self._read("get_referral_leaderboard", limit)
+
+    async def get_history_page(self, user_id: int, before_id: Optional[int] = None,
+                               after_id: Optional[int] = None,
+                               limit: int = 5) -> Tuple[List[dict], bool, bool]:
+        return await self._read("get_history_page", user_id, before_id,
+                                after_id, limit)
+
+    async def add_image_record(self, user_id: int, model: str, prompt: str,
+                               image_url: str, tokens_spent: int,
+                               content_hash: Optional[str] = None,
+                               reservation_key: Optional[str] = None,
+                               durability: str = DURABLE) -> bool:
+        return await self._enqueue(
+            image=(user_id, model, prompt, image_url, tokens_spent, content_hash),
+            commit=(user_id, reservation_key) if reservation_key else None,
+            durability=durability
+        )
+
+    # ========== ФАЙЛЫ TELEGRAM ==========
+    async def get_file_id(self, source_key: str) -> Optional[str]:
+        return await self._read("get_file_id", source_key)
+
+    async def save_file_id(self, source_key: str, file_id: str) -> bool:
+        return await self._write("save_file_id", source_key, file_id)
+
+    # ========== АНАЛИТИКА ==========
+    async def rollup_stats(self, batch_size: int = 5000) -> int:
+        return await self._write("rollup_stats", batch_size)
+
+    async def get_daily_stats(self, since_day: str, top: int = 5) -> dict:
+        return await self._read("get_daily_stats", since_day, top)
+
+    async def export_csv(self, kind: str, path: str) -> int:
+        """Выгрузить kind (database.EXPORTS) в CSV-файл path; возвращает число строк.
+
+        Идёт в отдельном потоке со своим соединением: долгая выгрузка
+        не занимает пул читателей, которым пользуются апдейты.
+        """
+        if self._writer is None:
+            await self._write("create_tables")
+        return await asyncio.to_thread(self._export_csv, kind, path)
+
+    def _export_csv(self, kind: str, path: str) -> int:
+        reader = Database(self.db_name, read_only=True)
+        rows = -1  # без заголовка
+        try:
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                for row in reader.iter_export(kind):
+                    writer.writerow(row)
+                    rows += 1
+        finally:
+            reader.close()
+        return rows
+
+    # ========== СОСТОЯНИЯ ДИАЛОГА ==========
+    async def save_conversation(self, user_id: int, state: str, data: str,
+                                expires_at: float) -> bool:
+        return await self._write("save_conversation", user_id, state, data, expires_at)
+
+    async def delete_conversation(self, user_id: int) -> bool:
+        return await self._write("delete_conversation", user_id)
+
+    async def load_conversations(self, now: float) -> List[dict]:
+        # Пишет (удаляет просроченные) - через поток-писатель
+        return await self._write("load_conversations", now)
+
+    # ========== РАССЫЛКИ ==========
+    async def create_broadcast(self, text: str) -> Optional[int]:
+        return await self._write("create_broadcast", text)
+
+    async def get_broadcast(self, broadcast_id: Optional[int] = None) -> Optional[dict]:
+        return await self._read("get_broadcast", broadcast_id)
+
+    async def claim_broadcast(self, owner: str, lease_until: float, now: float) -> Optional[dict]:
+        return await self._write("claim_broadcast", owner, lease_until, now)
+
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int = 500) -> List[int]:
+        return await self._read("get_broadcast_recipients", after_user_id, limit)
+
+    async def checkpoint_broadcast(self, broadcast_id: int, owner: str, last_user_id: int,
+                                   sent: int, failed: int, blocked_ids: List[int],
+                                   lease_until: float) -> bool:
+        result = await self._write("checkpoint_broadcast", broadcast_id, owner, last_user_id,
+                                   sent, failed, blocked_ids, lease_until)
+        # blocked_at в кэше устарел - перечитается при следующем обращении
+        self._invalidate(blocked_ids)
+        return result
+
+    async def finish_broadcast(self, broadcast_id: int, status: str) -> bool:
+        return await self._write("finish_broadcast", broadcast_id, status)
+
+    # ========== РАЗДЕЛЫ И АРХИВ ==========
+    async def partition_ledger(self, source: str, cutoff: str, batch_size: int = 5000) -> int:
+        return await self._write("partition_ledger", source, cutoff, batch_size)
+
+    async def get_partitions(self, source: Optional[str] = None) -> List[dict]:
+        return await self._read("get_partitions", source)
+
+    async def begin_archive(self, source: str, month: str, data_name: str) -> Optional[str]:
+        return await self._write("begin_archive", source, month, data_name)
+
+    async def drop_partition(self, source: str, month: str, path: str, data_name: str) -> bool:
+        return await self._write("drop_partition", source, month, path, data_name)
+
+    async def incremental_vacuum(self, pages: int = 1000) -> int:
+        return await self._write("incremental_vacuum", pages)
+
+    async def get_storage_stats(self) -> dict:
+        return await self._read("get_storage_stats")
+
+    async def stream_partition(self, source: str, month: str,
+                               consume: Callable[[Iterator[dict]], T]) -> T:
+        """consume(строки раздела) в отдельном потоке со своим соединением (как export_csv)"""
+        def run():
+            reader = Database(self.db_name, read_only=True)
+            try:
+                return consume(reader.iter_partition(source, month))
+            finally:
+                reader.close()
+        return await asyncio.to_thread(run)
+
+    async def warm_up(self):
+        """Открыть базу и проверить схему заранее, а не на первом апдейте"""
+        await self._write("create_tables")
+
+    async def close(self):
+        """Дождаться всех записей и закрыть соединения"""
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer_executor.shutdown, True)
+        await loop.run_in_executor(None, self._reader_executor.shutdown, True)
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        logger.info(f"✅ Veritabanı kapatıldı, kullanıcı önbelleği: {self.users_cache.stats()}")
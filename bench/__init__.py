@@ -0,0 +1,9 @@
+# bench - НАГРУЗОЧНОЕ ТЕСТИРОВАНИЕ ОБРАБОТЧИКОВ
+"""Офлайн-бенчмарк обработчиков бота.
+
+    python -m bench.runner --users 200 --backend async --backend blocking
+
+fake_bot  - Bot без сети, записывает исходящие вызовы Bot API;
+scenarios - синтетические апдейты: N пользователей ходят по меню и пишут промпты;
+runner    - прогон, пропускная способность, p50/p95/p99 и SQL на апдейт.
+"""
@@ -0,0 +1,77 @@
+# bench/fake_bot.py - BOT БЕЗ СЕТИ
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from telegram import Bot
+from telegram.request import BaseRequest, RequestData
+
+BOT_INFO = {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+class FakeRequest(BaseRequest):
+    """Транспорт Bot API без сети: отвечает правдоподобными объектами.
+
+    Все вызовы записываются в calls; latency - искусственная задержка
+    ответа Telegram в секундах.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: List[Tuple[str, dict]] = []
+        self.counts: Counter = Counter()
+        self._message_ids = itertools.count(10000)
+        self._file_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str,
+                         request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, parameters))
+        self.counts[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result = self._result(endpoint, parameters)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _result(self, endpoint: str, parameters: dict):
+        if endpoint == "getMe":
+            return BOT_INFO
+
+        message = {
+            "message_id": parameters.get("message_id") or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": parameters.get("chat_id", 1), "type": "private"},
+            "from": BOT_INFO,
+        }
+        if endpoint in ("sendMessage", "editMessageText"):
+            message["text"] = parameters.get("text", "")
+            return message
+        if endpoint == "sendPhoto":
+            file_id = f"bench-file-{next(self._file_ids)}"
+            message["photo"] = [
+                {"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}
+            ]
+            message["caption"] = parameters.get("caption", "")
+            return message
+        if endpoint == "sendDocument":
+            message["document"] = {"file_id": "bench-doc", "file_unique_id": "bench-doc"}
+            return message
+        # answerCallbackQuery, deleteMessage, setWebhook и т.п.
+        return True
+
+def make_fake_bot(latency: float = 0.0) -> Tuple[Bot, FakeRequest]:
+    """Bot, все запросы которого уходят в FakeRequest"""
+    request = FakeRequest(latency)
+    return Bot("123456:BENCH", request=request, get_updates_request=request), request
@@ -0,0 +1,216 @@
+# bench/runner.py - ПРОГОН НАГРУЗКИ
+"""Офлайн-нагрузка на обработчики бота.
+
+    python -m bench.runner --users 200 --prompts 2 --backend async --backend blocking
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from telegram import Update
+from telegram.ext import Application
+
+from async_db import AsyncDatabase
+from database import Database
+from rate_limit import RateLimiter
+from scheduler import GenerationScheduler
+from media_cache import FileIdCache
+from analytics import StatsRollup
+from retention import LedgerArchive, RetentionJob
+from conversation import ConversationStore
+from broadcast import Broadcaster
+from config import Config
+from bench.fake_bot import make_fake_bot
+from bench.scenarios import generate_flows, label
+import bot
+
+class BlockingDatabase:
+    """Исходное поведение: синхронные вызовы sqlite3 прямо в event loop"""
+
+    def __init__(self, db_name: str):
+        self.db = Database(db_name)
+
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+
+        async def call(*args, durability=None, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+    # Буфера нет; таблицы создаёт конструктор Database
+    pending_writes = 0
+
+    async def warm_up(self):
+        pass
+
+    async def flush(self) -> bool:
+        return True
+
+    async def close(self):
+        self.db.close()
+
+BACKENDS = {
+    "async": AsyncDatabase,
+    "blocking": BlockingDatabase,
+}
+
+class SQLCounter:
+    """Счётчик SQL-команд и коммитов со всех соединений (из любых потоков)"""
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, statement: str):
+        with self._lock:
+            self.statements += 1
+            if statement.lstrip().upper().startswith("COMMIT"):
+                self.commits += 1
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+async def run_backend(backend: str, users: int, prompts: int, concurrency: int,
+                      latency: float, seed: int) -> dict:
+    """Один прогон всех сессий на свежей базе"""
+    # Счётчик ставим до создания базы: соединения подхватывают его при открытии
+    counter = SQLCounter()
+    Database.trace_callback = counter
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    db = BACKENDS[backend](os.path.join(workdir, "bench.db"))
+
+    # Свежее состояние модуля бота для каждого прогона; лимиты частоты
+    # не мешают измерять сами обработчики
+    bot.db = db
+    bot.photo_cache = FileIdCache(db)
+    bot.stats_rollup = StatsRollup(db)
+    bot.conversations = ConversationStore(db if bot.CONVERSATION_PERSIST else None)
+    bot.retention = RetentionJob(db, LedgerArchive(os.path.join(workdir, "archive")))
+    bot.broadcaster = Broadcaster(db)
+    # Скачивание картинок из сети не входит в замер обработчиков
+    bot.image_store = None
+    bot.rate_limiter = RateLimiter({"default": (1e9, 1e9)})
+    bot.scheduler = GenerationScheduler(
+        workers=Config.GENERATION_WORKERS,
+        max_queue=max(Config.GENERATION_QUEUE_SIZE, users * prompts),
+        per_user_limit=Config.GENERATION_PER_USER,
+        per_user_queue=max(Config.GENERATION_PER_USER_QUEUE, prompts)
+    )
+
+    fake_bot, request = make_fake_bot(latency)
+    application = (
+        Application.builder()
+        .bot(fake_bot)
+        .updater(None)
+        .concurrent_updates(concurrency)
+        .build()
+    )
+    bot.register_handlers(application)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    flows = generate_flows(users, prompts, seed)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_user(updates: List[dict]):
+        # Апдейты одного пользователя - строго по очереди
+        async with semaphore:
+            for data in updates:
+                update = Update.de_json(data, fake_bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies[label(data)].append(time.perf_counter() - started)
+
+    try:
+        await application.initialize()
+        await bot.on_startup(application)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(updates) for updates in flows.values()))
+        # Ждём фоновые генерации и запись буфера
+        while bot.scheduler.queued or bot.scheduler.in_flight:
+            await asyncio.sleep(0.005)
+        await db.flush()
+        wall = time.perf_counter() - started
+    finally:
+        await bot.on_shutdown(application)
+        await application.shutdown()
+        Database.trace_callback = None
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    total = len(all_latencies)
+    return {
+        "backend": backend,
+        "updates": total,
+        "wall_s": round(wall, 3),
+        "updates_per_s": round(total / wall, 1),
+        "p50_ms": round(percentile(all_latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(all_latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(all_latencies, 99) * 1000, 2),
+        "statements_per_update": round(counter.statements / total, 2),
+        "commits_per_update": round(counter.commits / total, 2),
+        "api_calls": dict(request.counts),
+        "handlers": {
+            name: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+            }
+            for name, values in sorted(latencies.items())
+        },
+    }
+
+def print_report(results: List[dict]):
+    print(f"{'backend':<10} {'updates':>8} {'upd/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'sql/upd':>8} {'commit/upd':>10}")
+    for r in results:
+        print(f"{r['backend']:<10} {r['updates']:>8} {r['updates_per_s']:>8} {r['p50_ms']:>8} "
+              f"{r['p95_ms']:>8} {r['p99_ms']:>8} {r['statements_per_update']:>8} "
+              f"{r['commits_per_update']:>10}")
+
+    for r in results:
+        print(f"\n[{r['backend']}] handler latency")
+        for name, stats in r["handlers"].items():
+            print(f"  {name:<28} n={stats['count']:<6} p50={stats['p50_ms']:<8} "
+                  f"p95={stats['p95_ms']:<8} p99={stats['p99_ms']}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Offline handler benchmark")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--prompts", type=int, default=2, help="генераций на пользователя")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="искусственная задержка ответа Bot API")
+    parser.add_argument("--backend", action="append", choices=sorted(BACKENDS),
+                        help="можно указать несколько раз (по умолчанию все)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = []
+    for backend in args.backend or sorted(BACKENDS):
+        results.append(await run_backend(backend, args.users, args.prompts,
+                                         args.concurrency, args.latency_ms / 1000,
+                                         args.seed))
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        print_report(results)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+# bench/scenarios.py - СИНТЕТИЧЕСКИЕ АПДЕЙТЫ
+import itertools
+import random
+import time
+from typing import Dict, List, Optional
+
+from metrics import callback_branch
+
+PROMPTS = [
+    "Gün batımında İstanbul manzarası",
+    "Futbol oynayan robot",
+    "Uzayda Türk bayrağı",
+    "Orman içinde şelale",
+    "Deniz kenarında romantik çift",
+    "deniz manzarası",
+]
+
+_update_ids = itertools.count(1)
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id}"}
+
+def message_update(user_id: int, text: str) -> dict:
+    update_id = next(_update_ids)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+        ]
+    return {"update_id": update_id, "message": message}
+
+def callback_update(user_id: int, data: str, message_id: int = 1) -> dict:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        },
+    }
+
+# Сообщение вне режима генерации (не промпт)
+IDLE_TEXT = "merhaba"
+
+def label(update: dict) -> str:
+    """Имя ветки для отчёта: команда, callback_data или prompt"""
+    if "callback_query" in update:
+        return "callback:" + callback_branch(update["callback_query"]["data"])
+    text = update["message"]["text"]
+    if text == IDLE_TEXT:
+        return "text"
+    return text.split()[0] if text.startswith("/") else "prompt"
+
+def user_flow(user_id: int, rng: random.Random, prompts: int = 2,
+              referrer: Optional[int] = None) -> List[dict]:
+    """Типичная сессия: /start (возможно по ссылке), меню, генерации, баланс, история"""
+    start = "/start" if referrer is None else f"/start {referrer}"
+    updates = [message_update(user_id, start)]
+    if rng.random() < 0.3:
+        # Текст без кнопки генерации - только подсказка
+        updates.append(message_update(user_id, IDLE_TEXT))
+    for _ in range(prompts):
+        updates.append(callback_update(user_id, "menu_image"))
+        updates.append(callback_update(user_id, "generate_image"))
+        updates.append(message_update(user_id, rng.choice(PROMPTS)))
+        if rng.random() < 0.5:
+            updates.append(callback_update(user_id, "balance"))
+    updates.append(callback_update(user_id, "history"))
+    if rng.random() < 0.3:
+        updates.append(callback_update(user_id, "invite"))
+        updates.append(callback_update(user_id, "leaderboard"))
+    updates.append(callback_update(user_id, "back_to_main"))
+    return updates
+
+def generate_flows(users: int, prompts: int = 2, seed: int = 1) -> Dict[int, List[dict]]:
+    """Сессии для users пользователей (id с 100000)"""
+    rng = random.Random(seed)
+    flows = {}
+    for user_id in range(100000, 100000 + users):
+        # Часть пользователей приходит по ссылке одного из предыдущих
+        referrer = None
+        if user_id > 100000 and rng.random() < 0.3:
+            referrer = rng.randrange(100000, user_id)
+        flows[user_id] = user_flow(user_id, rng, prompts, referrer)
+    return flows
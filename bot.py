@@ -1,20 +1,44 @@
 # bot.py - NANO BANANA BOT (DEMO)
 import os
+import asyncio
 import logging
+import secrets
+import time
+import functools
+from datetime import datetime, timedelta
+import html
+import tempfile
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes
 )
 
 # Наши модули
-from database import Database
-from image_generator import image_gen
+from async_db import AsyncDatabase
+from database import (RESERVED, DUPLICATE, INSUFFICIENT, REFERRAL_BONUS, EXPORTS, PARTITION_ARCHIVED,
+                      BROADCAST_RUNNING, BROADCAST_CANCELLED)
+from providers import providers
+from gemini_generator import gemini_gen
+from image_store import ImageStore
+from scheduler import GenerationScheduler, QueueFullError
+from media_cache import FileIdCache, content_key
+from rate_limit import RateLimiter
+from analytics import StatsRollup
+from retention import LedgerArchive, RetentionJob
+from conversation import ConversationStore, AWAITING_PROMPT, PROMPT_ACCEPTED
+from outbound import OutboundScheduler
+from broadcast import Broadcaster
+from config import Config
+import metrics
+from tracing import tracer, profiler, startup, TracedRequest, GENERATOR, DOWNLOAD
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -29,8 +53,125 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Webhook-режим: включается, если задан публичный WEBHOOK_URL
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8443"))
+
+# Администратор (команда /debug); переменная окружения важнее config.py
+ADMIN_ID = os.getenv("ADMIN_ID", Config.ADMIN_ID)
+
+# Порт /metrics и /healthz (не задан - сервер метрик не запускается)
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+# Сколько апдейтов обрабатывается одновременно
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", Config.CONCURRENT_UPDATES))
+
+# Подписываемся только на типы апдейтов, которые обрабатываем
+# (ALLOWED_UPDATES=all - все типы, как раньше)
+ALLOWED_UPDATES = (
+    Update.ALL_TYPES if os.getenv("ALLOWED_UPDATES") == "all"
+    else Config.ALLOWED_UPDATES
+)
+
 # Инициализация базы данных
-db = Database()
+db = AsyncDatabase()
+
+# Модель генерации изображений (ключ в Config.PRICES)
+IMAGE_MODEL = "nano_banana"
+
+# Ограничение частоты запросов
+rate_limiter = RateLimiter(Config.RATE_LIMITS, global_limit=Config.RATE_LIMIT_GLOBAL)
+
+# Кэш file_id отправленных изображений
+photo_cache = FileIdCache(db)
+
+# Локальные копии сгенерированных изображений (пустой IMAGE_STORE_DIR - только URL)
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", Config.IMAGE_STORE_DIR)
+image_store = ImageStore(
+    IMAGE_STORE_DIR, providers.pool,
+    max_bytes=Config.IMAGE_STORE_MAX_MB * 1024 * 1024
+) if IMAGE_STORE_DIR else None
+
+# Состояния диалога: промптом считается только текст после кнопки генерации
+CONVERSATION_PERSIST = os.getenv("CONVERSATION_PERSIST", str(Config.CONVERSATION_PERSIST)).lower() in ("1", "true")
+conversations = ConversationStore(
+    db if CONVERSATION_PERSIST else None,
+    ttl=Config.CONVERSATION_TTL
+)
+
+# Очередь генераций
+scheduler = GenerationScheduler(
+    workers=Config.GENERATION_WORKERS,
+    max_queue=Config.GENERATION_QUEUE_SIZE,
+    per_user_limit=Config.GENERATION_PER_USER,
+    per_user_queue=Config.GENERATION_PER_USER_QUEUE
+)
+
+# Дневные сводки для /stats и /export
+stats_rollup = StatsRollup(db, interval=Config.STATS_ROLLUP_INTERVAL,
+                           batch_size=Config.STATS_ROLLUP_BATCH)
+
+# Перенос старых месяцев журналов в разделы и архив
+ledger_archive = LedgerArchive(os.getenv("ARCHIVE_DIR", Config.ARCHIVE_DIR))
+retention = RetentionJob(
+    db, ledger_archive,
+    interval=Config.RETENTION_INTERVAL,
+    hot_months=Config.RETENTION_HOT_MONTHS,
+    table_months=Config.RETENTION_TABLE_MONTHS,
+    batch_size=Config.RETENTION_BATCH,
+    vacuum_pages=Config.VACUUM_PAGES
+)
+
+# Исходящие запросы к Telegram: темп по чату и общий, слияние правок
+def build_outbound(share: float = 1.0) -> OutboundScheduler:
+    """share - доля общего лимита бота (воркеру кластера - 1 / воркеров)"""
+    rate, burst = Config.OUTBOUND_GLOBAL_RATE
+    return OutboundScheduler(
+        global_rate=(rate * share, max(1, burst * share)),
+        private_rate=Config.OUTBOUND_PRIVATE_RATE,
+        group_rate=Config.OUTBOUND_GROUP_RATE
+    )
+
+outbound = build_outbound()
+
+# Рассылки всем пользователям (/broadcast); отчёт о завершении - администратору.
+# BROADCAST_RUNNER - рассылки ведёт этот процесс (в кластере - фронт, cluster.py)
+BROADCAST_RUNNER = True
+BROADCAST_PAID = os.getenv("BROADCAST_PAID", str(Config.BROADCAST_PAID)).lower() in ("1", "true")
+broadcaster = Broadcaster(
+    db,
+    batch_size=Config.BROADCAST_BATCH,
+    concurrency=Config.BROADCAST_CONCURRENCY,
+    paid=BROADCAST_PAID,
+    lease=Config.BROADCAST_LEASE,
+    notify_chat=int(ADMIN_ID) if str(ADMIN_ID).isdigit() else None
+)
+
+# Очереди и кэши в метриках (глобальные имена читаются в момент запроса)
+metrics.QUEUE_DEPTH.set_function(lambda: scheduler.queued, "generation")
+metrics.IN_FLIGHT.set_function(lambda: scheduler.in_flight, "generation")
+metrics.QUEUE_DEPTH.set_function(lambda: db.pending_writes, "db_writes")
+metrics.QUEUE_DEPTH.set_function(lambda: outbound.queued, "telegram_out")
+metrics.CACHE_HIT_RATE.set_function(lambda: db.users_cache.stats()["hit_rate"], "users")
+metrics.CACHE_HIT_RATE.set_function(lambda: photo_cache.memory.stats()["hit_rate"], "file_ids")
+metrics_server = None
+
+PROCESSING_TEXT = (
+    "⏳ **Nano Banana görsel oluşturuyor...**\n"
+    "Lütfen 5-10 saniye bekleyin."
+)
+
+# Ответ на текст вне режима генерации
+IDLE_TEXT = (
+    "🤔 Görsel oluşturmak için önce **🍌 GÖRSEL OLUŞTUR** butonuna basın, "
+    "sonra açıklamanızı yazın.\n\n"
+    "👇 Menüden bir seçenek seçin:"
+)
+
+startup.mark("import")
 
 # ==================== КЛАВИАТУРЫ ====================
 def main_menu():
@@ -51,6 +192,69 @@ def cancel_button():
     keyboard = [[InlineKeyboardButton("❌ İptal", callback_data="cancel")]]
     return InlineKeyboardMarkup(keyboard)
 
+# ==================== МЕТРИКИ ====================
+def instrumented(handler):
+    """Обёртка обработчика: время и ошибки в метриках.
+    
+    Callback-кнопки считаются по ветке (callback:history_older),
+    остальные - по имени обработчика.
+    """
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        label = name
+        if update.callback_query:
+            label = "callback:" + metrics.callback_branch(update.callback_query.data)
+        started = time.perf_counter()
+        try:
+            with tracer.trace(label, update.update_id):
+                return await handler(update, context)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            metrics.HANDLER_LATENCY.observe(time.perf_counter() - started, label)
+            if startup.mark("first_update"):
+                logger.info(f"✅ 🚀 İlk güncelleme yanıtlandı: {startup.format()}")
+    return wrapper
+
+def is_admin(user_id: int) -> bool:
+    return str(user_id) == str(ADMIN_ID)
+
+# ==================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ====================
+async def rate_limit_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проверка лимитов до всех обработчиков (группа -1)"""
+    user = update.effective_user
+    if user is None:
+        return
+    
+    cost = 1
+    if update.callback_query:
+        kind = "callback"
+    elif update.message and update.message.text:
+        if update.message.text.startswith("/"):
+            kind = "command"
+        elif conversations.is_in(user.id, AWAITING_PROMPT):
+            # Промпт дорогой модели расходует больше токенов корзины
+            kind = "prompt"
+            cost = Config.PRICES[IMAGE_MODEL] / Config.RATE_LIMIT_PRICE_UNIT
+        else:
+            kind = "default"
+    else:
+        kind = "default"
+    
+    if rate_limiter.check(user.id, kind, cost):
+        return
+    
+    logger.info(f"🚦 Limit aşıldı: {user.id} ({kind})")
+    if rate_limiter.should_notify(user.id, kind):
+        if update.callback_query:
+            await update.callback_query.answer("⏳ Çok hızlısınız, lütfen biraz bekleyin.")
+        elif update.message:
+            await update.message.reply_text("⏳ Çok fazla istek gönderdiniz. Lütfen biraz bekleyin.")
+    raise ApplicationHandlerStop
+
 # ==================== ОБРАБОТЧИКИ КОМАНД ====================
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start"""
@@ -65,7 +269,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
     
     # Добавляем пользователя в базу (15.000 токенов)
-    db.add_user(
+    await db.add_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -74,7 +278,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Получаем баланс (всегда 15.000+ в демо)
-    tokens = db.get_user_tokens(user.id)
+    tokens = await db.get_user_tokens(user.id)
     
     welcome_text = (
         f"👋 Merhaba {user.first_name or ''}!\n"
@@ -93,7 +297,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать баланс"""
     user_id = update.effective_user.id
-    tokens = db.get_user_tokens(user_id)
+    tokens = await db.get_user_tokens(user_id)
     
     await update.message.reply_text(
         f"💰 **Bakiye Durumu**\n\n"
@@ -138,6 +342,194 @@ Gerçek AI API bağlantısı yakında eklenecek!
         parse_mode="HTML"
     )
 
+async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Трассировка и профилировщик (только администратор)
+    
+    /debug                      - состояние
+    /debug trace on|off         - трассировка апдейтов
+    /debug slow <мс>            - порог медленного апдейта
+    /debug last                 - последние медленные апдейты
+    /debug profile start|stop   - сэмплирующий профилировщик
+    """
+    if not is_admin(update.effective_user.id):
+        return
+    
+    args = [arg.lower() for arg in context.args or []]
+    command = args[0] if args else "status"
+    value = args[1] if len(args) > 1 else ""
+    
+    if command == "trace" and value in ("on", "off"):
+        tracer.enabled = value == "on"
+        text = f"✅ İzleme: {'açık' if tracer.enabled else 'kapalı'}"
+    elif command == "slow" and value.isdigit():
+        tracer.threshold = int(value) / 1000
+        text = f"✅ Yavaş güncelleme eşiği: {value} ms"
+    elif command == "last":
+        traces = list(tracer.slow)[-5:]
+        text = "\n\n".join(trace.format() for trace in traces) or "Yavaş güncelleme yok"
+    elif command == "profile" and value == "start":
+        profiler.start()
+        text = "✅ 🔬 Profil başladı. Durdurmak için: /debug profile stop"
+    elif command == "profile" and value == "stop":
+        path = await asyncio.to_thread(profiler.stop)
+        if not path:
+            text = "⚠️ Profil çalışmıyor"
+        else:
+            with open(path, "rb") as f:
+                await update.message.reply_document(f, caption="🔬 Collapsed stacks (flamegraph.pl / speedscope)")
+            return
+    elif command == "status":
+        text = (
+            f"🔧 **Debug**\n\n"
+            f"İzleme: {'açık' if tracer.enabled else 'kapalı'}\n"
+            f"Yavaş eşik: {tracer.threshold * 1000:.0f} ms\n"
+            f"Kayıtlı yavaş güncelleme: {len(tracer.slow)}\n"
+            f"Profil: {'çalışıyor' if profiler.running else 'kapalı'}\n"
+            f"Başlatma: {startup.format()}"
+        )
+    else:
+        text = (
+            "Kullanım:\n"
+            "/debug trace on|off\n"
+            "/debug slow <ms>\n"
+            "/debug last\n"
+            "/debug profile start|stop"
+        )
+    
+    await update.message.reply_text(text)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика по дневным сводкам (только администратор)
+    
+    /stats [дней]  - по умолчанию 7
+    """
+    if not is_admin(update.effective_user.id):
+        return
+    
+    days = max(1, int(context.args[0])) if context.args and context.args[0].isdigit() else 7
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    stats = await db.get_daily_stats(since)
+    
+    text = f"📊 **İstatistik** (son {days} gün)\n\n"
+    text += "**Günlük:**\n"
+    for row in stats["days"]:
+        text += f"{row['day']}: {row['generations']} görsel, {row['tokens']:,} token\n"
+    text += "\n**Modeller:**\n"
+    for row in stats["models"]:
+        text += f"{row['model']}: {row['generations']} görsel, {row['tokens']:,} token\n"
+    text += "\n**En çok harcayanlar:**\n"
+    for row in stats["users"]:
+        text += f"{row['user_id']}: {row['tokens_spent']:,} token, {row['generations']} görsel\n"
+    lag = stats["lag"]
+    text += (f"\n⏱ Özete işlenmemiş: {lag.get('images', 0)} görsel, "
+             f"{lag.get('transactions', 0)} işlem")
+    
+    await update.message.reply_text(text)
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """CSV-выгрузка (только администратор)
+    
+    /export models|users|transactions|images
+    """
+    if not is_admin(update.effective_user.id):
+        return
+    
+    kind = context.args[0].lower() if context.args else ""
+    if kind not in EXPORTS:
+        await update.message.reply_text(f"Kullanım: /export {'|'.join(EXPORTS)}")
+        return
+    
+    # Строки пишутся в файл по мере чтения, целиком в памяти не держатся
+    fd, path = tempfile.mkstemp(prefix=f"export-{kind}-", suffix=".csv")
+    os.close(fd)
+    try:
+        rows = await db.export_csv(kind, path)
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                f, filename=f"{kind}-{datetime.utcnow():%Y%m%d}.csv",
+                caption=f"📤 {kind}: {rows:,} satır"
+            )
+    finally:
+        os.remove(path)
+
+async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Разделы журналов и архив (только администратор)
+    
+    /archive             - размер базы и разделы
+    /archive <user_id>   - архивные операции пользователя
+    """
+    if not is_admin(update.effective_user.id):
+        return
+    
+    if context.args and context.args[0].isdigit():
+        target = int(context.args[0])
+        rows = await asyncio.to_thread(ledger_archive.lookup, "transactions", target)
+        if not rows:
+            await update.message.reply_text(f"📭 {target}: arşivde işlem yok")
+            return
+        text = f"📦 **{target}** - arşivde {len(rows)} işlem\n\n"
+        for row in rows[:10]:
+            text += f"{row['timestamp']} {row['action']} {row['tokens_change']:+d}\n"
+        await update.message.reply_text(text)
+        return
+    
+    storage = await db.get_storage_stats()
+    text = (
+        f"🗄 **Veritabanı:** {storage['bytes'] / 1024 / 1024:.1f} MB "
+        f"(boş {storage['free_bytes'] / 1024 / 1024:.1f} MB)\n\n"
+    )
+    for partition in await db.get_partitions():
+        mark = "📦" if partition['state'] == PARTITION_ARCHIVED else "🗂"
+        text += f"{mark} {partition['source']} {partition['month']}: {partition['rows']:,} kayıt\n"
+    await update.message.reply_text(text)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка всем пользователям (только администратор)
+    
+    /broadcast <текст>   - начать (текст - всё после команды, с переносами)
+    /broadcast status    - прогресс последней рассылки
+    /broadcast stop      - остановить идущую
+    """
+    if not is_admin(update.effective_user.id):
+        return
+    
+    parts = update.message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    command = text.lower()
+    
+    if command in ("", "status"):
+        job = await db.get_broadcast()
+        if job is None:
+            await update.message.reply_text(
+                "📭 Henüz duyuru yok\n\nKullanım:\n/broadcast <metin>\n/broadcast status\n/broadcast stop"
+            )
+            return
+        await update.message.reply_text(
+            f"📣 **Duyuru #{job['id']}** ({job['status']})\n\n"
+            f"👥 Alıcı: {job['total']:,}\n"
+            f"📨 Gönderildi: {job['sent']:,}\n"
+            f"🚫 Engelleyen: {job['blocked']:,}\n"
+            f"❌ Hata: {job['failed']:,}\n"
+            f"⏱ Son kullanıcı: {job['last_user_id']}"
+        )
+        return
+    
+    if command == "stop":
+        job = await db.get_broadcast()
+        if job is None or job['status'] != BROADCAST_RUNNING:
+            await update.message.reply_text("⚠️ Devam eden duyuru yok")
+            return
+        await db.finish_broadcast(job['id'], BROADCAST_CANCELLED)
+        await update.message.reply_text(f"🛑 Duyuru #{job['id']} durduruluyor")
+        return
+    
+    broadcast_id = await db.create_broadcast(text)
+    if broadcast_id is None:
+        await update.message.reply_text("⚠️ Devam eden bir duyuru var: /broadcast status")
+        return
+    broadcaster.wake()
+    await update.message.reply_text(f"✅ 📣 Duyuru #{broadcast_id} başladı. İlerleme: /broadcast status")
+
 # ==================== ОБРАБОТЧИКИ КНОПОК ====================
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий на кнопки"""
@@ -149,7 +541,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Главное меню
     if data == "back_to_main":
-        tokens = db.get_user_tokens(user_id)
+        await conversations.clear(user_id)
+        tokens = await db.get_user_tokens(user_id)
         await query.edit_message_text(
             text=f"🏠 **Ana Menü**\n\n💰 Bakiye: {tokens:,} token\n\n👇 Seçiminizi yapın:",
             reply_markup=main_menu(),
@@ -157,7 +550,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data == "menu_image":
-        tokens = db.get_user_tokens(user_id)
+        tokens = await db.get_user_tokens(user_id)
         await query.edit_message_text(
             text=f"🎨 **Nano Banana - AI Görsel Oluşturucu**\n\n"
                  f"🪙 Fiyat: **100 token** / görsel\n"
@@ -174,7 +567,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_generate_image(query, user_id)
     
     elif data == "balance":
-        tokens = db.get_user_tokens(user_id)
+        tokens = await db.get_user_tokens(user_id)
         await query.edit_message_text(
             text=f"💰 **Bakiye Durumu**\n\n"
                  f"🪙 Mevcut token: **{tokens:,}**\n"
@@ -185,49 +578,38 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data == "history":
-        history = db.get_user_history(user_id)
-        
-        if not history:
-            await query.edit_message_text(
-                "📭 Henüz işlem geçmişiniz yok.\nİlk görselinizi oluşturun!",
-                reply_markup=back_button()
-            )
-            return
-        
-        text = "📊 **Son İşlemleriniz:**\n\n"
-        for item in history[:5]:
-            action = item['action']
-            tokens_change = item['tokens_change']
-            details = item['details'][:30] if item['details'] else ""
-            
-            emoji = "🔼" if tokens_change > 0 else "🔽"
-            text += f"{emoji} **{action}**\n"
-            text += f"   🪙 {tokens_change:+d} token\n"
-            if details:
-                text += f"   📝 {details}...\n"
-            text += f"\n"
-        
-        await query.edit_message_text(
-            text,
-            reply_markup=back_button(),
-            parse_mode="HTML"
-        )
+        await show_history(query, user_id)
+    
+    elif data.startswith("history_older_"):
+        await show_history(query, user_id, before_id=int(data.rsplit("_", 1)[1]))
+    
+    elif data.startswith("history_newer_"):
+        await show_history(query, user_id, after_id=int(data.rsplit("_", 1)[1]))
     
     elif data == "invite":
         bot_username = (await context.bot.get_me()).username
         ref_link = f"https://t.me/{bot_username}?start={user_id}"
+        # Счётчики ведёт add_user - здесь только чтение строки из кэша
+        profile = await db.get_user_profile(user_id) or {}
         
+        keyboard = [
+            [InlineKeyboardButton("🏆 Liderlik Tablosu", callback_data="leaderboard")],
+            [InlineKeyboardButton("🔙 Ana Menü", callback_data="back_to_main")]
+        ]
         await query.edit_message_text(
             text=f"🎁 **Arkadaşını Davet Et**\n\n"
                  f"**Davet Linkin:**\n`{ref_link}`\n\n"
-                 f"✅ **Her davet için:** 2.000 token bonus!\n"
+                 f"✅ **Her davet için:** {REFERRAL_BONUS:,} token bonus!\n"
                  f"✅ **Arkadaşın satın alımından:** %20 komisyon\n\n"
-                 f"📈 **Şu ana kadar:** 0 kişi davet ettiniz\n"
-                 f"🪙 **Kazandığın token:** 0",
-            reply_markup=back_button(),
+                 f"📈 **Şu ana kadar:** {profile.get('referrals') or 0} kişi davet ettiniz\n"
+                 f"🪙 **Kazandığın token:** {profile.get('referral_earned') or 0:,}",
+            reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="HTML"
         )
     
+    elif data == "leaderboard":
+        await show_leaderboard(query)
+    
     elif data == "help":
         await query.edit_message_text(
             text=help_command.__doc__.replace("    ", ""),
@@ -236,15 +618,85 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data == "cancel":
+        await conversations.clear(user_id)
         await query.edit_message_text(
             text="❌ İşlem iptal edildi. Ana menüye yönlendiriliyorsunuz...",
             reply_markup=back_button()
         )
 
+async def show_history(query, user_id, before_id=None, after_id=None):
+    """Страница истории операций (курсор по id записи)"""
+    history, has_older, has_newer = await db.get_history_page(
+        user_id, before_id=before_id, after_id=after_id, limit=5
+    )
+    
+    if not history:
+        await query.edit_message_text(
+            "📭 Henüz işlem geçmişiniz yok.\nİlk görselinizi oluşturun!",
+            reply_markup=back_button()
+        )
+        return
+    
+    text = "📊 **Son İşlemleriniz:**\n\n"
+    for item in history:
+        action = item['action']
+        tokens_change = item['tokens_change']
+        details = item['details'][:30] if item['details'] else ""
+        
+        emoji = "🔼" if tokens_change > 0 else "🔽"
+        text += f"{emoji} **{action}**\n"
+        text += f"   🪙 {tokens_change:+d} token\n"
+        if details:
+            text += f"   📝 {details}...\n"
+        text += f"\n"
+    
+    # Кнопки листания: курсоры - id первой и последней записи страницы
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("◀️ Daha Yeni", callback_data=f"history_newer_{history[0]['id']}"))
+    if has_older:
+        nav.append(InlineKeyboardButton("Daha Eski ▶️", callback_data=f"history_older_{history[-1]['id']}"))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("🔙 Ana Menü", callback_data="back_to_main")])
+    
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
+
+async def show_leaderboard(query):
+    """Топ пригласивших (индекс по referrals, без подсчёта)"""
+    leaders = await db.get_referral_leaderboard(limit=10)
+    keyboard = [
+        [InlineKeyboardButton("🔙 Geri", callback_data="invite")],
+        [InlineKeyboardButton("🔙 Ana Menü", callback_data="back_to_main")]
+    ]
+    
+    if not leaders:
+        await query.edit_message_text(
+            "🏆 Henüz kimse arkadaş davet etmedi.\nİlk sen ol!",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    
+    medals = ["🥇", "🥈", "🥉"]
+    text = "🏆 **Davet Liderlik Tablosu**\n\n"
+    for place, leader in enumerate(leaders, 1):
+        name = html.escape(leader['first_name'] or leader['username'] or str(leader['user_id']))
+        mark = medals[place - 1] if place <= len(medals) else f"{place}."
+        text += f"{mark} {name} — {leader['referrals']} kişi, {leader['referral_earned']:,} token\n"
+    
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
+
 async def handle_generate_image(query, user_id):
     """Обработка запроса на генерацию изображения"""
-    price = 100
-    user_tokens = db.get_user_tokens(user_id)
+    price = Config.PRICES[IMAGE_MODEL]
+    user_tokens = await db.get_user_tokens(user_id)
     
     if user_tokens < price:
         await query.edit_message_text(
@@ -258,6 +710,7 @@ async def handle_generate_image(query, user_id):
         )
         return
     
+    await conversations.set(user_id, AWAITING_PROMPT)
     await query.edit_message_text(
         text=f"🎨 **Görsel Açıklaması Yazın**\n\n"
              f"🍌 **Nano Banana** AI görsel oluşturucu\n"
@@ -279,6 +732,18 @@ async def handle_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     prompt = update.message.text.strip()
     
+    # Повторная доставка уже принятого промпта - молча пропускаем
+    conversation = conversations.get(user_id)
+    if (conversation is not None and conversation.state == PROMPT_ACCEPTED
+            and conversation.data.get("update_id") == update.update_id):
+        logger.info(f"🔁 Tekrar gelen istek atlandı: gen:{update.update_id}")
+        return
+    
+    # Текст вне режима генерации: подсказка без базы и генератора
+    if not conversations.is_in(user_id, AWAITING_PROMPT):
+        await update.message.reply_text(IDLE_TEXT, reply_markup=main_menu())
+        return
+    
     if len(prompt) < 3:
         await update.message.reply_text(
             "❌ Lütfen en az 3 karakterlik bir açıklama yazın.\nÖrnek: 'Güneşli bir gün'",
@@ -286,32 +751,108 @@ async def handle_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    price = 100
-    user_tokens = db.get_user_tokens(user_id)
+    price = Config.PRICES[IMAGE_MODEL]
     
-    # Проверка баланса (в демо всегда должно хватать)
-    if user_tokens < price:
+    # Без строки в users резерв всегда "не хватает" - создаём её (как /start)
+    if await db.get_user_profile(user_id) is None:
+        user = update.effective_user
+        await db.add_user(user_id, user.username, user.first_name, user.last_name)
+    
+    # Резервируем токены атомарно; update_id - ключ идемпотентности,
+    # поэтому повторная доставка апдейта не спишет токены второй раз
+    reservation_key = f"gen:{update.update_id}"
+    status, user_tokens = await db.reserve_tokens(
+        user_id, price, reservation_key, "image_generation",
+        f"Nano Banana: {prompt[:50]}..."
+    )
+    if status == DUPLICATE:
+        logger.info(f"🔁 Tekrar gelen istek atlandı: {reservation_key}")
+        return
+    if status == INSUFFICIENT:
+        await update.message.reply_text(
+            f"❌ **Yetersiz bakiye**\n\n"
+            f"Bu görsel için {price} token gerekiyor.\n"
+            f"💰 Bakiyeniz: {user_tokens:,} token\n\n"
+            f"🎁 Arkadaşlarınızı davet ederek token kazanabilirsiniz!",
+            reply_markup=back_button()
+        )
+        return
+    if status != RESERVED:
         await update.message.reply_text(
-            f"⚠️ **Demo Modu Uyarısı**\n\n"
-            f"Normalde {price} token gerekiyor.\n"
-            f"Ama demo modunda devam ediyoruz!\n\n"
-            f"⏳ Görsel oluşturuluyor...",
+            "⚠️ Şu anda işlem yapılamıyor, lütfen biraz sonra tekrar deneyin.",
             reply_markup=back_button()
         )
+        return
+    
+    # Одна кнопка - один промпт; следующий - после новой кнопки.
+    # Состояние меняем только после резерва: апдейт, доставленный повторно
+    # до этого места, дойдёт до DUPLICATE, а после - до проверки выше
+    await conversations.set(user_id, PROMPT_ACCEPTED, update_id=update.update_id)
+    
+    # Улучшение промпта стартует сразу, а не когда задача дойдёт до воркера:
+    # промпты, принятые за окно батчера Gemini, уходят одним запросом,
+    # даже если ждут в очереди генераций
+    enhanced = asyncio.ensure_future(gemini_gen.agenerate_image_prompt(prompt))
     
     # Сообщение о начале генерации
     processing_msg = await update.message.reply_text(
-        "⏳ **Nano Banana görsel oluşturuyor...**\n"
-        "Lütfen 5-10 saniye bekleyin.",
+        PROCESSING_TEXT,
         reply_markup=None
     )
     
+    # Ставим генерацию в очередь; обработчик сразу освобождается.
+    # Пока задача ждёт, в сообщении показываем место в очереди
+    async def on_position(position: int):
+        if position > 0:
+            await processing_msg.edit_text(
+                f"⏳ **Sıradasınız: {position}**\n"
+                f"Görseliniz birazdan oluşturulacak..."
+            )
+        else:
+            await processing_msg.edit_text(PROCESSING_TEXT)
+    
+    # Остановка бота до или во время генерации - токены возвращаются
+    async def on_cancel():
+        enhanced.cancel()
+        await db.refund_reservation(user_id, reservation_key, "Üretim iptal edildi")
+    
     try:
-        # Генерируем изображение (демо-режим)
-        image_url, tokens_spent, error = image_gen.generate_image(
-            prompt=prompt,
-            model_type="nano"
+        scheduler.submit(
+            user_id,
+            lambda: run_generation(update, prompt, enhanced, reservation_key, processing_msg),
+            on_position=on_position,
+            on_cancel=on_cancel
+        )
+    except QueueFullError:
+        enhanced.cancel()
+        await db.refund_reservation(user_id, reservation_key, "Kuyruk dolu")
+        await processing_msg.edit_text(
+            "🚦 **Sistem şu anda çok yoğun.**\n"
+            "Lütfen biraz sonra tekrar deneyin, token'larınız iade edildi.",
+            reply_markup=back_button()
         )
+
+async def run_generation(update: Update, prompt: str, enhanced: asyncio.Future,
+                         reservation_key: str, processing_msg):
+    """Генерация и отправка изображения (выполняется воркером очереди)"""
+    user_id = update.effective_user.id
+    
+    # Воркер очереди работает вне контекста апдейта - своя трасса
+    with tracer.trace("generation", update.update_id):
+        await _run_generation(update, user_id, prompt, enhanced, reservation_key,
+                              processing_msg)
+
+async def _run_generation(update: Update, user_id: int, prompt: str,
+                          enhanced: asyncio.Future, reservation_key: str, processing_msg):
+    try:
+        # Генерируем изображение через адаптер модели (демо или HTTP API);
+        # недоступная модель заменяется запасной без ожидания таймаута.
+        # Промпт улучшен Gemini (запущено при приёме; дедлайн, без ключа - как есть)
+        with metrics.GENERATION_LATENCY.time(IMAGE_MODEL), tracer.span(GENERATOR):
+            image_prompt = await enhanced
+            provider, (image_url, tokens_spent, error) = await providers.generate(
+                IMAGE_MODEL, image_prompt
+            )
         
         if error:
             await processing_msg.edit_text(
@@ -319,82 +860,200 @@ async def handle_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=back_button()
             )
         
-        # "Списываем" токены (в демо только логируем)
-        db.add_tokens(user_id, -tokens_spent, "image_generation", 
-                     f"Nano Banana: {prompt[:50]}...")
-        
-        # Добавляем запись в базу
-        db.add_image_record(user_id, "🍌 Nano Banana", prompt, image_url, tokens_spent)
+        stored = await store_image(image_url)
         
-        # Отправляем изображение
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=f"🎨 **🍌 Nano Banana**\n\n"
+        # Отправляем изображение (баланс уже уменьшен резервом)
+        balance = await db.get_user_tokens(user_id)
+        await send_image(
+            update.message,
+            image_url,
+            stored,
+            caption=f"🎨 **{provider.title}**\n\n"
                    f"📝 **Açıklama:** {prompt}\n"
                    f"🪙 **Harcanan token:** {tokens_spent}\n"
-                   f"💰 **Kalan bakiye:** {db.get_user_tokens(user_id):,}\n\n"
-                   f"⭐ **Demo Modu** - Gerçek AI API yakında!\n"
-                   f"🔄 Yeni görsel için /start",
+                   f"💰 **Kalan bakiye:** {balance:,}\n\n"
+                   + (f"⭐ **Demo Modu** - Gerçek AI API yakında!\n" if error else "")
+                   + f"🔄 Yeni görsel için /start",
             parse_mode="HTML",
             reply_markup=back_button()
         )
         
-        # Удаляем сообщение "обработка"
-        await processing_msg.delete()
+        # Резерв подтверждаем только после доставки (ошибка отправки ещё вернёт
+        # токены) - тем же коммитом, что и запись об изображении
+        await db.add_image_record(user_id, provider.title, prompt, image_url, tokens_spent,
+                                  content_hash=stored.digest if stored else None,
+                                  reservation_key=reservation_key)
         
     except Exception as e:
         logger.error(f"❌ Generation error: {e}")
+        metrics.GENERATION_ERRORS.inc(IMAGE_MODEL)
         
         # Fallback - отправляем статичное изображение
         fallback_url = "https://images.unsplash.com/photo-1554080353-a576cf803bda?w=512&h=512&fit=crop"
         
-        await update.message.reply_photo(
-            photo=fallback_url,
+        # Генерация не удалась - возвращаем зарезервированные токены
+        # (False - резерв уже подтверждён, токены списаны)
+        refunded = await db.refund_reservation(
+            user_id, reservation_key, f"Nano Banana: {prompt[:50]}..."
+        )
+        spent_text = "0 (iade edildi)" if refunded else str(Config.PRICES[IMAGE_MODEL])
+        balance = await db.get_user_tokens(user_id)
+        
+        await photo_cache.reply_photo(
+            update.message,
+            fallback_url,
             caption=f"🎨 **🍌 Nano Banana**\n\n"
                    f"📝 **Açıklama:** {prompt}\n"
-                   f"🪙 **Harcanan token:** 100\n"
-                   f"💰 **Kalan bakiye:** {db.get_user_tokens(user_id):,}\n\n"
+                   f"🪙 **Harcanan token:** {spent_text}\n"
+                   f"💰 **Kalan bakiye:** {balance:,}\n\n"
                    f"⚠️ **Demo Görsel** - Sistem test aşamasında\n"
                    f"🔧 Gerçek AI API çok yakında!",
             parse_mode="HTML",
             reply_markup=back_button()
         )
-        
-        try:
-            await processing_msg.delete()
-        except:
-            pass
+    
+    # Удаляем сообщение "обработка"
+    try:
+        await processing_msg.delete()
+    except:
+        pass
 
-# ==================== ЗАПУСК БОТА ====================
-def main():
-    """Запуск бота"""
-    if not BOT_TOKEN:
-        logger.error("❌ BOT_TOKEN bulunamadı!")
-        logger.error("Railway → Variables → BOT_TOKEN ekleyin")
-        return
+async def store_image(image_url: str):
+    """Скачать результат в локальное хранилище; None - отправим по URL"""
+    if image_store is None:
+        return None
+    try:
+        with tracer.span(DOWNLOAD):
+            return await image_store.fetch(image_url)
+    except Exception as e:
+        logger.warning(f"⚠️ Görsel indirilemedi, URL ile gönderiliyor: {e}")
+        return None
+
+async def send_image(message, image_url: str, stored, **kwargs):
+    """Отправка: file_id из кэша, иначе локальный файл, иначе URL"""
+    if stored is None:
+        return await photo_cache.reply_photo(message, image_url, **kwargs)
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Ключ - хэш содержимого: та же картинка под другим URL берёт тот же file_id.
+    # Файл открываем только без file_id; пока он открыт, хранилище его не вытесняет
+    source_key = content_key(stored.digest)
+    sent = await photo_cache.reply_cached(message, source_key, **kwargs)
+    if sent is not None:
+        return sent
+    async with image_store.open(stored.digest) as photo:
+        if photo is None:
+            # Уже вытеснен - отправим по URL
+            return await photo_cache.upload(message, image_url, image_url, **kwargs)
+        return await photo_cache.upload(message, photo, source_key, **kwargs)
+
+# ==================== ЗАПУСК БОТА ====================
+async def on_startup(application: Application):
+    """Запуск воркеров очереди генераций и сервера метрик"""
+    global metrics_server
+    await scheduler.start()
+    await db.warm_up()
+    # Резервы генераций, прерванных падением процесса, возвращаем пользователям
+    await db.refund_stale_reservations(Config.RESERVATION_TIMEOUT)
+    await conversations.load()
+    stats_rollup.start()
+    retention.start()
+    if BROADCAST_RUNNER:
+        broadcaster.start(application.bot)
+    if METRICS_PORT:
+        metrics_server = await metrics.start_http_server(int(METRICS_PORT))
+    startup.mark("init")
+    logger.info(f"✅ 🚀 Başlatma süresi: {startup.format()}")
+
+async def on_shutdown(application: Application):
+    """Остановить очередь, дописать записи и закрыть базу"""
+    global metrics_server
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+    await scheduler.stop()
+    await stats_rollup.stop()
+    await retention.stop()
+    await broadcaster.stop()
+    await conversations.flush()
+    await providers.close()
+    await db.close()
+
+def register_handlers(application: Application):
+    """Регистрация всех обработчиков"""
+    # Ограничение частоты - раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, rate_limit_check), group=-1)
     
     # Обработчики команд
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("balance", balance_command))
-    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("start", instrumented(start_command)))
+    application.add_handler(CommandHandler("balance", instrumented(balance_command)))
+    application.add_handler(CommandHandler("help", instrumented(help_command)))
+    application.add_handler(CommandHandler("debug", instrumented(debug_command)))
+    application.add_handler(CommandHandler("stats", instrumented(stats_command)))
+    application.add_handler(CommandHandler("export", instrumented(export_command)))
+    application.add_handler(CommandHandler("archive", instrumented(archive_command)))
+    application.add_handler(CommandHandler("broadcast", instrumented(broadcast_command)))
     
     # Обработчики кнопок
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(instrumented(button_handler)))
     
     # Обработчики текстовых сообщений (промпты)
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, 
-        handle_prompt
+        instrumented(handle_prompt)
     ))
+
+def main():
+    """Запуск бота"""
+    if not BOT_TOKEN:
+        logger.error("❌ BOT_TOKEN bulunamadı!")
+        logger.error("Railway → Variables → BOT_TOKEN ekleyin")
+        return
+    
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(TracedRequest(connection_pool_size=256))
+        .rate_limiter(outbound)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    register_handlers(application)
+    startup.mark("build")
     
     # Запуск
     logger.info("✅ 🤖 Nano Banana AI Bot başlatılıyor...")
     logger.info("✅ 🎨 Demo modu aktif")
     logger.info("✅ 💰 Her kullanıcıya 15.000 token")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        run_webhook(application)
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+def run_webhook(application: Application):
+    """Webhook-режим: локальный HTTP-сервер, Telegram сам присылает апдейты.
+
+    Telegram передаёт WEBHOOK_SECRET в заголовке
+    X-Telegram-Bot-Api-Secret-Token; запросы без него отклоняются.
+    Локально можно слать синтетические апдейты скриптом post_update.py.
+    """
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("⚠️ WEBHOOK_SECRET yok, rastgele gizli anahtar üretildi")
+    
+    logger.info(f"✅ 🌐 Webhook modu: {WEBHOOK_LISTEN}:{PORT}/{WEBHOOK_PATH}")
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=PORT,
+        url_path=WEBHOOK_PATH,
+        secret_token=secret,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        allowed_updates=ALLOWED_UPDATES
+    )
 
 if __name__ == "__main__":
     main()
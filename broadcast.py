@@ -0,0 +1,202 @@
+# broadcast.py - РАССЫЛКИ
+"""Рассылка сообщения всем пользователям (команда /broadcast).
+
+Получатели читаются из users пачками по первичному ключу (keyset:
+user_id > последнего), без заблокировавших бота. Отправка идёт
+параллельно (до concurrency запросов), темп задаёт OutboundScheduler:
+рассылка уходит с приоритетом PRIORITY_BULK и не задерживает ответы
+пользователям. Бесплатно она не быстрее общего темпа бота
+(OUTBOUND_GLOBAL_RATE, по умолчанию 25/сек: 100.000 получателей - около
+67 минут); с paid (allow_paid_broadcast) - до 1000/сек, около 2 минут.
+
+Прогресс сохраняется в broadcasts после каждой пачки: last_user_id -
+наибольший id, до которого включительно все отправки завершены. После
+перезапуска рассылка продолжается с него; повторно могут прийти только
+сообщения, отправленные после последней отметки (не больше пачки).
+
+Forbidden (бот заблокирован, аккаунт удалён) и "chat not found" отмечают
+пользователя в users.blocked_at - следующие рассылки его пропускают.
+Рассылку ведёт один процесс: он берёт её в аренду (owner, lease_until)
+и продлевает аренду на каждой отметке; если процесс упал, после
+истечения аренды рассылку подхватит другой процесс или перезапуск.
+"""
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+from database import BROADCAST_DONE
+from outbound import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+class _Progress:
+    """Завершённые отправки с прошлой отметки"""
+
+    def __init__(self, last_user_id: int):
+        self.last_user_id = last_user_id
+        # user_id -> завершена ли отправка, в порядке user_id
+        self.pending: "OrderedDict[int, bool]" = OrderedDict()
+        self.sent = 0
+        self.failed = 0
+        self.blocked: List[int] = []
+
+    def done(self, user_id: int):
+        self.pending[user_id] = True
+        # Отметка сдвигается только по непрерывному префиксу завершённых
+        while self.pending:
+            first, finished = next(iter(self.pending.items()))
+            if not finished:
+                break
+            self.pending.popitem(last=False)
+            self.last_user_id = first
+
+    def reset(self):
+        self.sent = self.failed = 0
+        self.blocked = []
+
+class Broadcaster:
+    def __init__(self, db, batch_size: int = 500, concurrency: int = 64,
+                 paid: bool = False, interval: float = 30.0, lease: float = 120.0,
+                 notify_chat: Optional[int] = None):
+        self.db = db
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        # allow_paid_broadcast: до 1000 сообщений в секунду за Telegram Stars
+        self.paid = paid
+        self.interval = interval
+        self.lease = lease
+        self.notify_chat = notify_chat
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.bot = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    # ========== ОТПРАВКА ==========
+    async def _deliver(self, user_id: int, text: str, progress: _Progress,
+                       semaphore: asyncio.Semaphore):
+        try:
+            await self.bot.send_message(
+                chat_id=user_id, text=text,
+                rate_limit_args=PRIORITY_BULK,
+                api_kwargs={"allow_paid_broadcast": True} if self.paid else None
+            )
+            progress.sent += 1
+        except Forbidden:
+            progress.blocked.append(user_id)
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                progress.blocked.append(user_id)
+            else:
+                progress.failed += 1
+                logger.warning(f"⚠️ Duyuru gönderilemedi ({user_id}): {e}")
+        except Exception as e:
+            # RetryAfter сюда доходит, только если исчерпаны повторы планировщика
+            progress.failed += 1
+            logger.warning(f"⚠️ Duyuru gönderilemedi ({user_id}): {e}")
+        finally:
+            semaphore.release()
+        # Отменённая отправка (остановка бота) не завершена - отметку не сдвигает
+        progress.done(user_id)
+
+    async def _checkpoint(self, job: dict, progress: _Progress, release: bool = False) -> bool:
+        """Сохранить прогресс и продлить аренду (release - отдать рассылку сразу)"""
+        blocked = progress.blocked
+        sent, failed = progress.sent, progress.failed
+        progress.reset()
+        return await self.db.checkpoint_broadcast(
+            job["id"], self.owner, progress.last_user_id, sent, failed, blocked,
+            0.0 if release else time.time() + self.lease
+        )
+
+    async def run(self, job: dict) -> bool:
+        """Отправить рассылку с сохранённой отметки; False - отменена или отдана другому"""
+        progress = _Progress(job["last_user_id"])
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        after = job["last_user_id"]
+        logger.info(f"📣 Duyuru #{job['id']} gönderiliyor ({after} sonrasından)")
+        try:
+            while True:
+                recipients = await self.db.get_broadcast_recipients(after, self.batch_size)
+                for user_id in recipients:
+                    await semaphore.acquire()
+                    progress.pending[user_id] = False
+                    task = asyncio.create_task(self._deliver(user_id, job["text"], progress, semaphore))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if len(recipients) < self.batch_size:
+                    break
+                after = recipients[-1]
+                if not await self._checkpoint(job, progress):
+                    logger.info(f"📣 Duyuru #{job['id']} durduruldu")
+                    return False
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # Остановка бота: сохраняем завершённое и отдаём рассылку -
+            # перезапуск (или другой процесс) продолжит с отметки
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._checkpoint(job, progress, release=True)
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if not await self._checkpoint(job, progress):
+            return False
+        await self.db.finish_broadcast(job["id"], BROADCAST_DONE)
+        result = await self.db.get_broadcast(job["id"])
+        logger.info(f"✅ Duyuru #{job['id']} tamamlandı: {result['sent']} gönderildi, "
+                    f"{result['blocked']} engelli, {result['failed']} hata")
+        if self.notify_chat:
+            try:
+                await self.bot.send_message(
+                    chat_id=self.notify_chat,
+                    text=(f"✅ Duyuru #{job['id']} tamamlandı\n"
+                          f"📨 Gönderildi: {result['sent']:,}\n"
+                          f"🚫 Engelleyen: {result['blocked']:,}\n"
+                          f"❌ Hata: {result['failed']:,}")
+                )
+            except TelegramError as e:
+                logger.warning(f"⚠️ Duyuru raporu gönderilemedi: {e}")
+        return True
+
+    # ========== ФОНОВАЯ ЗАДАЧА ==========
+    def wake(self):
+        """Проверить рассылки сейчас, не дожидаясь interval (новая рассылка)"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                job = await self.db.claim_broadcast(self.owner, time.time() + self.lease, time.time())
+                if job is not None:
+                    await self.run(job)
+                    continue
+            except Exception as e:
+                logger.error(f"❌ Duyuru görevi hatası: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot):
+        if self._task is None:
+            self.bot = bot
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._loop(), name="broadcast")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,183 @@
+# cluster.py - МНОГОПРОЦЕССНЫЙ РЕЖИМ
+"""Несколько процессов-воркеров за одним фронтом.
+
+    python cluster.py --workers 4
+
+Фронт получает апдейты (polling или webhook, как bot.py) и отправляет
+каждый воркеру по хэшу user_id. Все апдейты пользователя обрабатывает
+один и тот же процесс, поэтому его лимиты частоты, очередь генераций
+и кэш профиля живут в одном месте. Строку пользователя могут изменить и
+другие воркеры, поэтому кэш профиля в воркере живёт CLUSTER_CACHE_TTL секунд.
+
+Воркеры - обычный bot.py без получения апдейтов, с общей базой в
+режиме WAL (писатели разных процессов ждут друг друга busy_timeout).
+
+Рассылки (/broadcast) ведёт фронт: воркеру досталась бы лишь 1 / воркеров
+общего лимита Telegram, фронт отправляет с полным OUTBOUND_GLOBAL_RATE.
+Ответы воркеров идут параллельно со своими долями; если вместе они
+упрутся в лимит Telegram, 429 из многих чатов приостанавливают рассылку
+(OutboundScheduler распознаёт общий лимит).
+"""
+import os
+import json
+import zlib
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+def worker_for(user_id: int, workers: int) -> int:
+    """Номер воркера пользователя (стабилен между перезапусками)"""
+    return zlib.crc32(str(user_id).encode()) % workers
+
+# ========== ВОРКЕР ==========
+def run_worker(index: int, workers: int, updates: multiprocessing.Queue):
+    """Точка входа процесса-воркера"""
+    # У каждого воркера свой порт метрик: METRICS_PORT + 1 + index
+    if os.getenv("METRICS_PORT"):
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + 1 + index)
+    try:
+        asyncio.run(_worker_main(index, workers, updates))
+    except KeyboardInterrupt:
+        pass
+
+async def _worker_main(index: int, workers: int, updates: multiprocessing.Queue):
+    import bot
+    from tracing import TracedRequest
+
+    # Общий лимит Telegram на бота делится поровну; чат пользователя
+    # всегда в одном воркере, поэтому темп по чату остаётся точным
+    bot.outbound = bot.build_outbound(share=1 / workers)
+    # Рассылки ведёт фронт с полным лимитом; воркер только ставит их в очередь
+    bot.BROADCAST_RUNNER = False
+    # Строку пользователя меняют и другие воркеры (бонус пригласившему,
+    # рассылка, возврат резервов при старте) - кэш профилей живёт недолго
+    bot.db.users_cache.ttl = bot.Config.CLUSTER_CACHE_TTL
+    application = (
+        Application.builder()
+        .token(bot.BOT_TOKEN)
+        .request(TracedRequest(connection_pool_size=256))
+        .rate_limiter(bot.outbound)
+        .updater(None)
+        .concurrent_updates(bot.CONCURRENT_UPDATES)
+        .build()
+    )
+    bot.register_handlers(application)
+
+    loop = asyncio.get_running_loop()
+    # queue.get блокирует - отдельный поток, чтобы не занимать общий пул
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cluster-queue")
+
+    async with application:
+        await bot.on_startup(application)
+        await application.start()
+        logger.info(f"✅ 🧩 Worker {index} hazır (pid {os.getpid()})")
+        try:
+            while True:
+                data = await loop.run_in_executor(reader, updates.get)
+                if data is None:
+                    break
+                update = Update.de_json(json.loads(data), application.bot)
+                await application.update_queue.put(update)
+        finally:
+            await application.stop()
+            await bot.on_shutdown(application)
+            reader.shutdown(wait=False)
+    logger.info(f"✅ 🧩 Worker {index} durdu")
+
+# ========== ФРОНТ ==========
+class Router:
+    """Раздаёт апдейты воркерам; упавший воркер перезапускается"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self.queues: List[multiprocessing.Queue] = [
+            self._context.Queue() for _ in range(workers)
+        ]
+        self.processes: List[multiprocessing.Process] = [None] * workers
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=run_worker, args=(index, self.workers, self.queues[index]),
+            name=f"bot-worker-{index}", daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        logger.info(f"✅ 🧩 {self.workers} worker başlatıldı")
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        index = worker_for(user.id, self.workers) if user else 0
+
+        process = self.processes[index]
+        if not process.is_alive():
+            logger.error(f"❌ Worker {index} düştü (kod {process.exitcode}), yeniden başlatılıyor")
+            self._spawn(index)
+
+        # Queue.put не блокирует: данные уходят в канал фоновым потоком
+        self.queues[index].put(update.to_json())
+
+    def stop(self, timeout: float = 30.0):
+        """Дать воркерам обработать очередь и завершиться"""
+        for update_queue in self.queues:
+            update_queue.put(None)
+        for index, process in enumerate(self.processes):
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"⚠️ Worker {index} zamanında durmadı, sonlandırılıyor")
+                process.terminate()
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process bot")
+    parser.add_argument("--workers", type=int,
+                        default=int(os.getenv("WORKERS", os.cpu_count() or 1)))
+    args = parser.parse_args()
+
+    import bot
+    if not bot.BOT_TOKEN:
+        logger.error("❌ BOT_TOKEN bulunamadı!")
+        return
+
+    router = Router(args.workers)
+
+    async def start_broadcasts(application: Application):
+        bot.broadcaster.start(application.bot)
+
+    async def stop_workers(application: Application):
+        # Рассылка сохраняет отметку до остановки воркеров
+        await bot.broadcaster.stop()
+        await bot.db.close()
+        await asyncio.to_thread(router.stop)
+
+    # Фронт принимает апдейты и ведёт рассылки (без обработчиков бота).
+    # Рассылке - весь общий лимит: у воркера была бы только 1 / воркеров
+    application = (
+        Application.builder()
+        .token(bot.BOT_TOKEN)
+        .rate_limiter(bot.build_outbound())
+        .post_init(start_broadcasts)
+        .post_shutdown(stop_workers)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, router.route))
+
+    router.start()
+    if bot.WEBHOOK_URL:
+        bot.run_webhook(application)
+    else:
+        application.run_polling(allowed_updates=bot.ALLOWED_UPDATES)
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,45 @@ class Config:
     
     DEFAULT_TOKENS = 15000
     
+    # Очередь генераций
+    GENERATION_WORKERS = 4          # одновременных генераций всего
+    GENERATION_QUEUE_SIZE = 100     # максимум задач в очереди
+    GENERATION_PER_USER = 1         # одновременных генераций на пользователя
+    GENERATION_PER_USER_QUEUE = 5   # ожидающих задач на пользователя
+    RESERVATION_TIMEOUT = 900       # сек: неподтверждённый резерв старше - вернуть при старте
+    
+    # Состояния диалога (ожидание промпта и т.п.)
+    CONVERSATION_TTL = 600          # секунд до сброса состояния
+    CONVERSATION_PERSIST = False    # дублировать в SQLite (переживает перезапуск)
+    
+    # Обработка апдейтов
+    CONCURRENT_UPDATES = 32         # апдейтов обрабатывается одновременно
+    CLUSTER_CACHE_TTL = 5.0         # сек жизни профиля в кэше воркера (cluster.py)
+    ALLOWED_UPDATES = ["message", "callback_query"]
+    
+    # Исходящие запросы к Telegram: (в секунду, всплеск)
+    OUTBOUND_GLOBAL_RATE = (25.0, 5)        # на весь бот (в кластере делится между воркерами)
+    OUTBOUND_PRIVATE_RATE = (1.0, 3)        # на личный чат
+    OUTBOUND_GROUP_RATE = (20 / 60, 3)      # на группу
+    
+    # Рассылки (/broadcast). Бесплатно они идут в общем темпе OUTBOUND_GLOBAL_RATE:
+    # при 25/сек 100.000 пользователей - около 67 минут; BROADCAST_PAID - около 2 минут
+    BROADCAST_BATCH = 500           # получателей на пачку (и на отметку прогресса)
+    BROADCAST_CONCURRENCY = 64      # одновременных отправок
+    BROADCAST_PAID = False          # allow_paid_broadcast: до 1000/сек, платно (Stars)
+    BROADCAST_LEASE = 120           # секунд аренды рассылки процессом
+    
+    # Ограничение частоты: (токенов в секунду, размер корзины) по типу обработчика
+    RATE_LIMITS = {
+        "command": (0.5, 5),
+        "callback": (2.0, 10),
+        "prompt": (0.2, 3),
+        "default": (1.0, 5),
+    }
+    RATE_LIMIT_GLOBAL = (50.0, 200)  # на все апдейты бота вместе
+    # Промпт модели стоит PRICES[модель] / RATE_LIMIT_PRICE_UNIT токенов корзины
+    RATE_LIMIT_PRICE_UNIT = 100
+    
     PRICES = {
         "nano_banana": 100,
         "nano_banana_pro": 200,
@@ -22,6 +61,48 @@ class Config:
         "suno": 300
     }
     
+    # Модели изображений: название, максимум одновременных запросов к API,
+    # таймаут, целевая задержка для AIMD-лимита и задержка хедж-запроса (сек)
+    IMAGE_PROVIDERS = {
+        "nano_banana": {"title": "🍌 Nano Banana", "max_connections": 8, "timeout": 30,
+                        "latency_target": 10, "hedge_after": 12},
+        "nano_banana_pro": {"title": "🍌 Nano Banana Pro", "max_connections": 4, "timeout": 60,
+                            "latency_target": 20, "hedge_after": None},
+        "gpt_image": {"title": "🖼 GPT Image", "max_connections": 4, "timeout": 60,
+                      "latency_target": 20, "hedge_after": None},
+        "midjourney": {"title": "🎨 Midjourney", "max_connections": 2, "timeout": 120,
+                       "latency_target": 60, "hedge_after": None},
+        "recraft": {"title": "✏️ Recraft", "max_connections": 4, "timeout": 60,
+                    "latency_target": 20, "hedge_after": None},
+    }
+    # Запасные модели по порядку (цена для пользователя - как у выбранной)
+    IMAGE_FALLBACKS = {
+        "nano_banana": ["nano_banana_pro", "gpt_image"],
+        "nano_banana_pro": ["nano_banana", "gpt_image"],
+        "gpt_image": ["nano_banana_pro", "recraft"],
+        "midjourney": ["recraft", "gpt_image"],
+        "recraft": ["gpt_image", "nano_banana_pro"],
+    }
+    CIRCUIT_FAILURES = 5            # ошибок подряд до отключения модели
+    CIRCUIT_RESET = 30              # секунд до пробного запроса
+    HTTP_POOL_SIZE = 100            # соединений в общем HTTP-пуле
+    
+    # Локальное хранилище изображений
+    IMAGE_STORE_DIR = "images"
+    IMAGE_STORE_MAX_MB = 512        # LRU-вытеснение сверх этого размера
+    
+    # Дневные сводки для /stats и /export
+    STATS_ROLLUP_INTERVAL = 60      # секунд между обновлениями сводок
+    STATS_ROLLUP_BATCH = 5000       # строк за одну транзакцию
+    
+    # Хранение журналов: горячая таблица -> помесячные разделы -> архив (gzip JSONL)
+    RETENTION_HOT_MONTHS = 1        # месяцев в горячих таблицах (1 - текущий)
+    RETENTION_TABLE_MONTHS = 2      # ещё месяцев в таблицах-разделах до архива
+    RETENTION_INTERVAL = 3600       # секунд между проходами
+    RETENTION_BATCH = 5000          # строк за одну транзакцию переноса
+    ARCHIVE_DIR = "archive"
+    VACUUM_PAGES = 2000             # страниц за один incremental_vacuum
+    
     TEXTS = {
         "welcome": "👋 Merhaba! Bakiyende {tokens} token var – bunları yapay zeka sorguları için kullanabilirsin.",
         "balance": "💰 Bakiye: {tokens} token",
@@ -0,0 +1,80 @@
+# conversation.py - СОСТОЯНИЯ ДИАЛОГА
+"""Состояние диалога пользователя (как состояния ConversationHandler).
+
+Текст обрабатывается как промпт, только если пользователь нажал
+"🍌 GÖRSEL OLUŞTUR" и находится в состоянии AWAITING_PROMPT. Любой другой
+текст получает короткую подсказку без обращения к базе и генератору.
+
+Состояния живут в памяти (LRU с TTL) - проверка на каждом сообщении
+не делает запросов. Если передана база, переходы дублируются в таблицу
+conversation_states (в фоне, обработчик не ждёт коммита) и загружаются
+при старте, поэтому перезапуск не сбрасывает пользователя, который как
+раз пишет промпт.
+"""
+import asyncio
+import json
+import time
+import logging
+from typing import NamedTuple, Optional, Set
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Ждём текст промпта после кнопки генерации
+AWAITING_PROMPT = "awaiting_prompt"
+# Промпт принят (токены зарезервированы); data["update_id"] - его апдейт
+PROMPT_ACCEPTED = "prompt_accepted"
+
+class Conversation(NamedTuple):
+    state: str
+    data: dict
+
+class ConversationStore:
+    def __init__(self, db=None, ttl: float = 600.0, maxsize: int = 100000):
+        # db=None - только память
+        self.db = db
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._writes: Set[asyncio.Task] = set()
+
+    async def load(self):
+        """Поднять непросроченные состояния из базы (при старте)"""
+        if self.db is None:
+            return
+        now = time.time()
+        rows = await self.db.load_conversations(now)
+        for row in rows:
+            self.memory.put(row["user_id"],
+                            Conversation(row["state"], json.loads(row["data"] or "{}")),
+                            ttl=row["expires_at"] - now)
+        logger.info(f"✅ 💬 Diyalog durumları yüklendi: {len(rows)}")
+
+    def get(self, user_id: int) -> Optional[Conversation]:
+        """Текущее состояние (только память, без запросов)"""
+        return self.memory.get(user_id)
+
+    def is_in(self, user_id: int, state: str) -> bool:
+        conversation = self.memory.get(user_id)
+        return conversation is not None and conversation.state == state
+
+    def _persist(self, write):
+        # Поток-писатель один, задачи стартуют по порядку - set/clear не переставятся
+        task = asyncio.create_task(write)
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def set(self, user_id: int, state: str, **data):
+        self.memory.put(user_id, Conversation(state, data))
+        if self.db is not None:
+            self._persist(self.db.save_conversation(user_id, state, json.dumps(data),
+                                                    time.time() + self.ttl))
+
+    async def clear(self, user_id: int):
+        if self.memory.pop(user_id) is not None and self.db is not None:
+            self._persist(self.db.delete_conversation(user_id))
+
+    async def flush(self):
+        """Дождаться фоновых записей (перед закрытием базы)"""
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
@@ -2,80 +2,350 @@
 import sqlite3
 import logging
 from datetime import datetime
-from typing import Optional, List, Tuple
+from typing import Callable, Iterator, Optional, List, Tuple
 
 logger = logging.getLogger(__name__)
 
+START_TOKENS = 15000
+# Бонус пригласившему за каждого нового пользователя
+REFERRAL_BONUS = 2000
+
+# Результаты резервирования токенов
+RESERVED = "reserved"
+DUPLICATE = "duplicate"
+INSUFFICIENT = "insufficient"
+FAILED = "failed"
+
+def demo_balance(tokens: Optional[int]) -> int:
+    """Баланс для показа (если пользователя ещё нет - стартовые 15.000)"""
+    if tokens is None:
+        return START_TOKENS
+    return tokens
+
+# ========== МИГРАЦИИ ==========
+# Каждый элемент - список SQL-команд одной версии схемы.
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    # v1: базовые таблицы
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            tokens INTEGER DEFAULT 15000,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            referrals INTEGER DEFAULT 0,
+            total_spent INTEGER DEFAULT 0,
+            invited_by INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action TEXT,
+            tokens_change INTEGER,
+            details TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reservations (
+            idempotency_key TEXT PRIMARY KEY,
+            user_id INTEGER,
+            amount INTEGER,
+            status TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            model TEXT,
+            prompt TEXT,
+            image_url TEXT,
+            tokens_spent INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ],
+    # v2: индексы для истории пользователя (keyset-пагинация по id)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_images_user_id ON images (user_id, id)",
+    ],
+    # v3: file_id уже отправленных в Telegram изображений
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            source_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ],
+    # v4: sha256 локальной копии изображения (image_store)
+    [
+        "ALTER TABLE images ADD COLUMN content_hash TEXT",
+    ],
+    # v5: счётчики рефералов ведутся в add_user; индекс для таблицы лидеров.
+    # Разовый пересчёт уже записанных invited_by - единственный COUNT по рефералам.
+    [
+        "ALTER TABLE users ADD COLUMN referral_earned INTEGER DEFAULT 0",
+        '''
+        UPDATE users SET referrals = (
+            SELECT COUNT(*) FROM users AS invited
+            WHERE invited.invited_by = users.user_id AND invited.user_id != users.user_id
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_users_referrals ON users (referrals DESC, user_id)",
+    ],
+    # v6: дневные сводки для аналитики (заполняет rollup_stats по водяной отметке)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS daily_model_stats (
+            day TEXT,
+            model TEXT,
+            generations INTEGER DEFAULT 0,
+            tokens INTEGER DEFAULT 0,
+            PRIMARY KEY (day, model)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_user_stats (
+            day TEXT,
+            user_id INTEGER,
+            generations INTEGER DEFAULT 0,
+            tokens_spent INTEGER DEFAULT 0,
+            tokens_earned INTEGER DEFAULT 0,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS rollup_watermarks (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        )
+        ''',
+    ],
+    # v7: помесячные разделы журналов (retention.py) и представления над ними
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ledger_partitions (
+            source TEXT,
+            month TEXT,
+            state TEXT,
+            rows INTEGER DEFAULT 0,
+            path TEXT,
+            PRIMARY KEY (source, month)
+        )
+        ''',
+        "CREATE VIEW IF NOT EXISTS transactions_all AS SELECT * FROM transactions",
+        "CREATE VIEW IF NOT EXISTS images_all AS SELECT * FROM images",
+    ],
+    # v8: состояния диалога (conversation.py), срок - unix-время
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            data TEXT,
+            expires_at REAL NOT NULL
+        )
+        ''',
+    ],
+    # v9: рассылки (broadcast.py); заблокировавшие бота пропускаются
+    [
+        "ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP",
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            owner TEXT,
+            lease_until REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+    ],
+    # v10: бонусы за приглашения, записанные до v5 (v5 пересчитала только
+    # referrals, а бонус тогда не начислялся). Недоплату по 2.000 токенов
+    # (REFERRAL_BONUS на момент миграции) за приглашение начисляем так же,
+    # как add_user: строкой referral_bonus в журнале, балансом и referral_earned.
+    [
+        '''
+        INSERT INTO transactions (user_id, action, tokens_change, details)
+        SELECT user_id, 'referral_bonus', referrals * 2000 - COALESCE(referral_earned, 0),
+               'Eski davetler: ' || referrals
+        FROM users
+        WHERE COALESCE(referral_earned, 0) < referrals * 2000
+        ''',
+        '''
+        UPDATE users SET
+            tokens = tokens + referrals * 2000 - COALESCE(referral_earned, 0),
+            referral_earned = referrals * 2000
+        WHERE COALESCE(referral_earned, 0) < referrals * 2000
+        ''',
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# ========== РАЗДЕЛЫ ЖУРНАЛОВ ==========
+# Горячая таблица -> (колонка времени, колонки). Старые месяцы переносятся
+# в таблицы <source>_YYYYMM с той же схемой; <source>_all объединяет все.
+LEDGERS = {
+    "transactions": ("timestamp", (
+        ("id", "INTEGER PRIMARY KEY"), ("user_id", "INTEGER"), ("action", "TEXT"),
+        ("tokens_change", "INTEGER"), ("details", "TEXT"), ("timestamp", "TIMESTAMP"),
+    )),
+    "images": ("created_at", (
+        ("id", "INTEGER PRIMARY KEY"), ("user_id", "INTEGER"), ("model", "TEXT"),
+        ("prompt", "TEXT"), ("image_url", "TEXT"), ("tokens_spent", "INTEGER"),
+        ("created_at", "TIMESTAMP"), ("content_hash", "TEXT"),
+    )),
+}
+# Состояния раздела в ledger_partitions
+PARTITION_TABLE = "table"
+PARTITION_ARCHIVING = "archiving"   # таблица ещё есть, архив пишется (path - файл данных)
+PARTITION_ARCHIVED = "archived"
+
+def partition_table(source: str, month: str) -> str:
+    """Имя таблицы раздела: month - 'YYYY-MM'"""
+    if source not in LEDGERS or len(month) != 7 or not month.replace("-", "").isdigit():
+        raise ValueError(f"Geçersiz bölüm: {source} {month}")
+    return f"{source}_{month.replace('-', '')}"
+
+# ========== РАССЫЛКИ ==========
+BROADCAST_RUNNING = "running"
+BROADCAST_DONE = "done"
+BROADCAST_CANCELLED = "cancelled"
+
+# ========== ЭКСПОРТ ==========
+# Вид выгрузки -> (таблица, колонки, колонки ключа для keyset-пагинации)
+EXPORTS = {
+    "models": ("daily_model_stats", ("day", "model", "generations", "tokens"), ("day", "model")),
+    "users": ("daily_user_stats",
+              ("day", "user_id", "generations", "tokens_spent", "tokens_earned"),
+              ("day", "user_id")),
+    "transactions": ("transactions_all",
+                     ("id", "user_id", "action", "tokens_change", "details", "timestamp"),
+                     ("id",)),
+    "images": ("images_all",
+               ("id", "user_id", "model", "tokens_spent", "content_hash", "created_at"),
+               ("id",)),
+}
+
 class Database:
-    def __init__(self, db_name="bot.db"):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+    # Необязательный обработчик всех SQL-команд (бенчмарки, отладка)
+    trace_callback: Optional[Callable[[str], None]] = None
+    # Предупреждение о базе без incremental_vacuum - один раз на процесс
+    _vacuum_warned = False
+    
+    def __init__(self, db_name="bot.db", read_only: bool = False):
+        if read_only:
+            # Соединение только для чтения (пул читателей в AsyncDatabase)
+            self.conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True,
+                                        check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db_name, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
-        self.create_tables()
-        logger.info("✅ Veritabanı başlatıldı (Demo Modu)")
+        if Database.trace_callback is not None:
+            self.conn.set_trace_callback(Database.trace_callback)
+        self.conn.execute("PRAGMA busy_timeout = 5000")
+        
+        if not read_only:
+            # Для новой базы: место удалённых разделов возвращается по частям
+            # (incremental_vacuum); у существующей базы ничего не меняет
+            self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # WAL: читатели не блокируют писателя и наоборот
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.create_tables()
+            logger.info("✅ Veritabanı başlatıldı (Demo Modu)")
     
     def create_tables(self):
-        """Создаём таблицы если их нет"""
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                tokens INTEGER DEFAULT 15000,
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                referrals INTEGER DEFAULT 0,
-                total_spent INTEGER DEFAULT 0,
-                invited_by INTEGER
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                action TEXT,
-                tokens_change INTEGER,
-                details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                model TEXT,
-                prompt TEXT,
-                image_url TEXT,
-                tokens_spent INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        """Создаём таблицы и применяем недостающие миграции.
+
+        Версия схемы хранится в PRAGMA user_version; каждая миграция
+        применяется в своей транзакции вместе с новым номером версии.
+        Версия перепроверяется под блокировкой записи: несколько процессов
+        (cluster.py) могут открыть базу одновременно.
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
         
-        self.conn.commit()
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                current = self.conn.execute("PRAGMA user_version").fetchone()[0]
+                if current >= target:
+                    self.conn.rollback()
+                    continue
+                for statement in MIGRATIONS[target - 1]:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {target}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                logger.error(f"❌ Şema geçişi başarısız: v{target}")
+                raise
+            logger.info(f"✅ Şema güncellendi: v{target}")
     
     # ========== ПОЛЬЗОВАТЕЛИ ==========
     def add_user(self, user_id: int, username: str, first_name: str, 
                  last_name: str, invited_by: Optional[int] = None) -> bool:
-        """Добавить нового пользователя (всегда 15.000 токенов)"""
+        """Добавить нового пользователя (всегда 15.000 токенов).
+        
+        В той же транзакции пригласившему начисляется REFERRAL_BONUS и
+        увеличиваются его счётчики referrals/referral_earned - экран
+        приглашений читает готовые числа из строки пользователя.
+        """
+        if invited_by == user_id:
+            invited_by = None
         try:
-            cursor = self.conn.cursor()
-            
-            # Проверяем, есть ли уже пользователь
-            cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-            if cursor.fetchone():
-                logger.info(f"✅ Kullanıcı zaten var: {user_id}")
-                return True  # Уже есть
-            
-            # Добавляем пользователя с 15.000 токенами
-            cursor.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name, tokens, invited_by)
-                VALUES (?, ?, ?, ?, 15000, ?)
-            ''', (user_id, username, first_name, last_name, invited_by))
+            with self.conn:
+                cursor = self.conn.cursor()
+                
+                # Добавляем пользователя с 15.000 токенами (повторный /start - ничего)
+                cursor.execute('''
+                    INSERT INTO users (user_id, username, first_name, last_name, tokens, invited_by)
+                    VALUES (?, ?, ?, ?, 15000, ?)
+                    ON CONFLICT (user_id) DO NOTHING
+                ''', (user_id, username, first_name, last_name, invited_by))
+                if cursor.rowcount == 0:
+                    # Снова написал боту - значит, разблокировал; рассылки снова доходят
+                    cursor.execute('''
+                        UPDATE users SET blocked_at = NULL
+                        WHERE user_id = ? AND blocked_at IS NOT NULL
+                    ''', (user_id,))
+                    logger.info(f"✅ Kullanıcı zaten var: {user_id}")
+                    return True  # Уже есть
+                
+                if invited_by is not None:
+                    cursor.execute('''
+                        UPDATE users
+                        SET referrals = referrals + 1,
+                            referral_earned = referral_earned + ?,
+                            tokens = tokens + ?
+                        WHERE user_id = ?
+                    ''', (REFERRAL_BONUS, REFERRAL_BONUS, invited_by))
+                    if cursor.rowcount:
+                        cursor.execute('''
+                            INSERT INTO transactions (user_id, action, tokens_change, details)
+                            VALUES (?, 'referral_bonus', ?, ?)
+                        ''', (invited_by, REFERRAL_BONUS, f"Davet: {user_id}"))
             
-            self.conn.commit()
             logger.info(f"✅ Yeni kullanıcı: {user_id} - 15.000 token verildi")
             return True
             
@@ -83,24 +353,60 @@ class Database:
             logger.error(f"❌ Kullanıcı eklenemedi: {e}")
             return False
     
+    def get_user_profile(self, user_id: int) -> Optional[dict]:
+        """Получить строку пользователя целиком (None если нет)"""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"❌ Kullanıcı okunamadı: {e}")
+            return None
+    
+    def get_user_profiles(self, user_ids: List[int]) -> List[dict]:
+        """Получить строки нескольких пользователей одним запросом"""
+        if not user_ids:
+            return []
+        try:
+            placeholders = ",".join("?" * len(user_ids))
+            cursor = self.conn.cursor()
+            cursor.execute(f"SELECT * FROM users WHERE user_id IN ({placeholders})",
+                           list(user_ids))
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ Kullanıcılar okunamadı: {e}")
+            return []
+    
+    def get_referral_leaderboard(self, limit: int = 10) -> List[dict]:
+        """Лучшие по числу приглашённых (индекс idx_users_referrals, без сортировки)"""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                SELECT user_id, username, first_name, referrals, referral_earned
+                FROM users
+                WHERE referrals > 0
+                ORDER BY referrals DESC, user_id
+                LIMIT ?
+            ''', (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ Liderlik tablosu okunamadı: {e}")
+            return []
+    
     def get_user_tokens(self, user_id: int) -> int:
-        """Получить баланс токенов (в демо всегда минимум 15.000)"""
+        """Получить баланс токенов"""
         try:
             cursor = self.conn.cursor()
             cursor.execute("SELECT tokens FROM users WHERE user_id = ?", (user_id,))
             row = cursor.fetchone()
             
             if row:
-                tokens = row['tokens']
-                # В демо-режиме если меньше 15.000, показываем 15.000
-                if tokens < 15000:
-                    logger.info(f"⚠️ Düşük bakiye: {user_id} -> {tokens}, 15000 gösteriliyor")
-                    return 15000
-                return tokens
+                return demo_balance(row['tokens'])
             else:
                 # Если пользователя нет, создаём с 15.000
                 logger.info(f"⚠️ Kullanıcı yok, demo bakiye: 15000")
-                return 15000
+                return demo_balance(None)
                 
         except Exception as e:
             logger.error(f"❌ Token okunamadı: {e}")
@@ -131,37 +437,761 @@ class Database:
             logger.error(f"❌ Token işlemi hatası: {e}")
             return True  # В демо всегда успешно
     
+    def reserve_tokens(self, user_id: int, amount: int, idempotency_key: str,
+                       action: str, details: str = "") -> Tuple[str, int]:
+        """Зарезервировать (списать) токены одним условным UPDATE.
+
+        Повторный вызов с тем же ключом (повторная доставка апдейта от
+        Telegram) ничего не списывает и возвращает DUPLICATE.
+        Возвращает (статус, баланс после операции).
+        """
+        try:
+            with self.conn:
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    INSERT INTO reservations (idempotency_key, user_id, amount, status)
+                    VALUES (?, ?, ?, 'reserved')
+                    ON CONFLICT(idempotency_key) DO NOTHING
+                ''', (idempotency_key, user_id, amount))
+                if cursor.rowcount == 0:
+                    return DUPLICATE, self.get_user_tokens(user_id)
+                
+                cursor.execute('''
+                    UPDATE users SET tokens = tokens - ?
+                    WHERE user_id = ? AND tokens >= ?
+                    RETURNING tokens
+                ''', (amount, user_id, amount))
+                row = cursor.fetchone()
+                if row is None:
+                    # Не хватает токенов - откатываем и запись резерва
+                    self.conn.rollback()
+                    return INSUFFICIENT, self.get_user_tokens(user_id)
+                
+                cursor.execute('''
+                    INSERT INTO transactions (user_id, action, tokens_change, details)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, action, -amount, details))
+            
+            logger.info(f"🪙 Rezerv: {user_id} -> {-amount} ({idempotency_key})")
+            return RESERVED, row['tokens']
+            
+        except Exception as e:
+            logger.error(f"❌ Rezerv hatası: {e}")
+            return FAILED, self.get_user_tokens(user_id)
+    
+    def _commit_reservations(self, cursor, commits: List[Tuple[int, str]]) -> int:
+        """Подтвердить резервы (user_id, idempotency_key) в текущей транзакции"""
+        committed = 0
+        for user_id, idempotency_key in commits:
+            cursor.execute('''
+                UPDATE reservations SET status = 'committed'
+                WHERE idempotency_key = ? AND user_id = ? AND status = 'reserved'
+                RETURNING amount
+            ''', (idempotency_key, user_id))
+            row = cursor.fetchone()
+            if row is None:
+                continue
+            
+            cursor.execute(
+                "UPDATE users SET total_spent = total_spent + ? WHERE user_id = ?",
+                (row['amount'], user_id)
+            )
+            committed += 1
+        return committed
+    
+    def commit_reservation(self, user_id: int, idempotency_key: str) -> bool:
+        """Подтвердить резерв (генерация прошла успешно)"""
+        try:
+            with self.conn:
+                return self._commit_reservations(self.conn.cursor(),
+                                                 [(user_id, idempotency_key)]) > 0
+        except Exception as e:
+            logger.error(f"❌ Rezerv onaylanamadı: {e}")
+            return False
+    
+    def refund_reservation(self, user_id: int, idempotency_key: str,
+                           details: str = "") -> bool:
+        """Вернуть зарезервированные токены (генерация не удалась)"""
+        try:
+            with self.conn:
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    UPDATE reservations SET status = 'refunded'
+                    WHERE idempotency_key = ? AND user_id = ? AND status = 'reserved'
+                    RETURNING amount
+                ''', (idempotency_key, user_id))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                
+                cursor.execute(
+                    "UPDATE users SET tokens = tokens + ? WHERE user_id = ?",
+                    (row['amount'], user_id)
+                )
+                cursor.execute('''
+                    INSERT INTO transactions (user_id, action, tokens_change, details)
+                    VALUES (?, 'refund', ?, ?)
+                ''', (user_id, row['amount'], details))
+            
+            logger.info(f"↩️ İade: {user_id} -> +{row['amount']} ({idempotency_key})")
+            return True
+        except Exception as e:
+            logger.error(f"❌ İade hatası: {e}")
+            return False
+    
+    def refund_stale_reservations(self, max_age: float) -> List[int]:
+        """Вернуть токены резервов старше max_age секунд (генерация прервана).
+    
+        Вызывается при старте: резерв, который за это время не подтверждён
+        и не возвращён, остался от упавшего или остановленного процесса.
+        Возвращает пользователей, чей баланс изменился.
+        """
+        try:
+            with self.conn:
+                rows = self.conn.execute('''
+                    UPDATE reservations SET status = 'refunded'
+                    WHERE status = 'reserved' AND created_at < datetime('now', ?)
+                    RETURNING user_id, amount
+                ''', (f"-{int(max_age)} seconds",)).fetchall()
+                self.conn.executemany(
+                    "UPDATE users SET tokens = tokens + ? WHERE user_id = ?",
+                    [(row['amount'], row['user_id']) for row in rows]
+                )
+                self.conn.executemany('''
+                    INSERT INTO transactions (user_id, action, tokens_change, details)
+                    VALUES (?, 'refund', ?, 'Yarım kalan üretim')
+                ''', [(row['user_id'], row['amount']) for row in rows])
+        except Exception as e:
+            logger.error(f"❌ Eski rezervler iade edilemedi: {e}")
+            return []
+        if rows:
+            logger.warning(f"↩️ {len(rows)} yarım kalan rezerv iade edildi")
+        return [row['user_id'] for row in rows]
+    
     # ========== ИСТОРИЯ ==========
     def get_user_history(self, user_id: int, limit: int = 5) -> List[dict]:
         """Получить историю операций пользователя"""
+        rows, _, _ = self.get_history_page(user_id, limit=limit)
+        return rows
+    
+    def get_history_page(self, user_id: int, before_id: Optional[int] = None,
+                         after_id: Optional[int] = None,
+                         limit: int = 5) -> Tuple[List[dict], bool, bool]:
+        """Страница истории по курсору (keyset), от новых к старым.
+
+        before_id - страница старше этой записи, after_id - новее.
+        Стоимость не зависит от длины истории: индекс (user_id, id).
+        Возвращает (записи, есть_старше, есть_новее).
+        
+        Сначала читается горячая таблица; помесячные разделы (представление
+        transactions_all) - только если в ней не хватило строк на страницу.
+        """
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT action, tokens_change, details, timestamp
-                FROM transactions
-                WHERE user_id = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (user_id, limit))
+            if after_id is not None:
+                # Курсор мог остаться в разделе - новее него могут быть и там
+                rows = self._history_rows("transactions_all", user_id, "id > ?",
+                                          (after_id,), "ASC", limit + 1)
+                has_newer = len(rows) > limit
+                return list(reversed(rows[:limit])), True, has_newer
             
-            return [dict(row) for row in cursor.fetchall()]
-        except:
-            return []
+            where, params = ("id < ?", (before_id,)) if before_id is not None else ("1", ())
+            rows = self._history_rows("transactions", user_id, where, params, "DESC", limit + 1)
+            if len(rows) <= limit:
+                rows = self._history_rows("transactions_all", user_id, where, params,
+                                          "DESC", limit + 1)
+            has_older = len(rows) > limit
+            return rows[:limit], has_older, before_id is not None
+        except Exception as e:
+            logger.error(f"❌ Geçmiş okunamadı: {e}")
+            return [], False, False
+    
+    def _history_rows(self, table: str, user_id: int, where: str, params: tuple,
+                      order: str, limit: int) -> List[dict]:
+        cursor = self.conn.execute(f'''
+            SELECT id, action, tokens_change, details, timestamp
+            FROM {table}
+            WHERE user_id = ? AND {where}
+            ORDER BY id {order}
+            LIMIT ?
+        ''', (user_id, *params, limit))
+        return [dict(row) for row in cursor.fetchall()]
     
     def add_image_record(self, user_id: int, model: str, prompt: str, 
-                         image_url: str, tokens_spent: int) -> bool:
-        """Добавить запись о сгенерированном изображении"""
+                         image_url: str, tokens_spent: int,
+                         content_hash: Optional[str] = None,
+                         reservation_key: Optional[str] = None) -> bool:
+        """Добавить запись о сгенерированном изображении.
+        
+        reservation_key - резерв, который подтверждается тем же коммитом.
+        """
+        try:
+            with self.conn:
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    INSERT INTO images (user_id, model, prompt, image_url, tokens_spent, content_hash)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, model, prompt, image_url, tokens_spent, content_hash))
+                if reservation_key:
+                    self._commit_reservations(cursor, [(user_id, reservation_key)])
+            return True
+        except Exception as e:
+            logger.error(f"❌ Görsel kaydedilemedi: {e}")
+            return False
+    
+    # ========== ФАЙЛЫ TELEGRAM ==========
+    def get_file_id(self, source_key: str) -> Optional[str]:
+        """file_id, который Telegram вернул при первой отправке источника"""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT file_id FROM telegram_files WHERE source_key = ?",
+                           (source_key,))
+            row = cursor.fetchone()
+            return row['file_id'] if row else None
+        except Exception as e:
+            logger.error(f"❌ file_id okunamadı: {e}")
+            return None
+    
+    def save_file_id(self, source_key: str, file_id: str) -> bool:
+        """Запомнить file_id (или удалить, если file_id пустой)"""
+        try:
+            with self.conn:
+                if file_id:
+                    self.conn.execute('''
+                        INSERT OR REPLACE INTO telegram_files (source_key, file_id)
+                        VALUES (?, ?)
+                    ''', (source_key, file_id))
+                else:
+                    self.conn.execute("DELETE FROM telegram_files WHERE source_key = ?",
+                                      (source_key,))
+            return True
+        except Exception as e:
+            logger.error(f"❌ file_id kaydedilemedi: {e}")
+            return False
+    
+    # ========== АНАЛИТИКА ==========
+    def _watermark(self, source: str) -> int:
+        row = self.conn.execute(
+            "SELECT last_id FROM rollup_watermarks WHERE source = ?", (source,)
+        ).fetchone()
+        return row['last_id'] if row else 0
+    
+    def _next_batch(self, table: str, last_id: int, batch_size: int) -> Tuple[Optional[int], int]:
+        """(id последней строки, число строк) следующей пачки после водяной отметки"""
+        row = self.conn.execute(f'''
+            SELECT MAX(id) AS upto, COUNT(*) AS size FROM (
+                SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?
+            )
+        ''', (last_id, batch_size)).fetchone()
+        return row['upto'], row['size']
+    
+    def rollup_stats(self, batch_size: int = 5000) -> int:
+        """Добавить в дневные сводки следующую пачку images и transactions.
+        
+        Обрабатываются только строки с id выше сохранённой водяной отметки;
+        прибавление к сводкам и сдвиг отметки - в одной транзакции, поэтому
+        после падения или из нескольких процессов строка не учитывается
+        дважды. Возвращает число обработанных строк (0 - всё учтено).
+        """
+        processed = 0
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            
+            last_id = self._watermark("images")
+            upto, size = self._next_batch("images", last_id, batch_size)
+            if upto is not None:
+                self.conn.execute('''
+                    INSERT INTO daily_model_stats (day, model, generations, tokens)
+                    SELECT date(created_at), model, COUNT(*), COALESCE(SUM(tokens_spent), 0)
+                    FROM images WHERE id > ? AND id <= ?
+                    GROUP BY 1, 2
+                    ON CONFLICT (day, model) DO UPDATE SET
+                        generations = generations + excluded.generations,
+                        tokens = tokens + excluded.tokens
+                ''', (last_id, upto))
+                self.conn.execute('''
+                    INSERT INTO daily_user_stats (day, user_id, generations)
+                    SELECT date(created_at), user_id, COUNT(*)
+                    FROM images WHERE id > ? AND id <= ?
+                    GROUP BY 1, 2
+                    ON CONFLICT (day, user_id) DO UPDATE SET
+                        generations = generations + excluded.generations
+                ''', (last_id, upto))
+                self.conn.execute('''
+                    INSERT INTO rollup_watermarks (source, last_id) VALUES ('images', ?)
+                    ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id
+                ''', (upto,))
+                processed += size
+            
+            last_id = self._watermark("transactions")
+            upto, size = self._next_batch("transactions", last_id, batch_size)
+            if upto is not None:
+                # Возврат (refund) - не заработок, а отмена траты: вычитается
+                # из tokens_spent, чтобы сводки сходились с чистым журналом
+                self.conn.execute('''
+                    INSERT INTO daily_user_stats (day, user_id, tokens_spent, tokens_earned)
+                    SELECT date(timestamp), user_id,
+                           COALESCE(SUM(CASE WHEN tokens_change < 0 THEN -tokens_change
+                                             WHEN action = 'refund' THEN -tokens_change END), 0),
+                           COALESCE(SUM(CASE WHEN tokens_change > 0 AND action != 'refund'
+                                             THEN tokens_change END), 0)
+                    FROM transactions WHERE id > ? AND id <= ?
+                    GROUP BY 1, 2
+                    ON CONFLICT (day, user_id) DO UPDATE SET
+                        tokens_spent = tokens_spent + excluded.tokens_spent,
+                        tokens_earned = tokens_earned + excluded.tokens_earned
+                ''', (last_id, upto))
+                self.conn.execute('''
+                    INSERT INTO rollup_watermarks (source, last_id) VALUES ('transactions', ?)
+                    ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id
+                ''', (upto,))
+                processed += size
+            
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"❌ Günlük özet güncellenemedi: {e}")
+            return 0
+        
+        if processed:
+            logger.info(f"📊 Günlük özet: {processed} kayıt işlendi")
+        return processed
+    
+    def get_daily_stats(self, since_day: str, top: int = 5) -> dict:
+        """Сводка с since_day (YYYY-MM-DD) только по таблицам дневных сводок"""
         try:
             cursor = self.conn.cursor()
             cursor.execute('''
-                INSERT INTO images (user_id, model, prompt, image_url, tokens_spent)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, model, prompt, image_url, tokens_spent))
+                SELECT day, SUM(generations) AS generations, SUM(tokens) AS tokens
+                FROM daily_model_stats WHERE day >= ?
+                GROUP BY day ORDER BY day
+            ''', (since_day,))
+            days = [dict(row) for row in cursor.fetchall()]
             
+            cursor.execute('''
+                SELECT model, SUM(generations) AS generations, SUM(tokens) AS tokens
+                FROM daily_model_stats WHERE day >= ?
+                GROUP BY model ORDER BY generations DESC
+            ''', (since_day,))
+            models = [dict(row) for row in cursor.fetchall()]
+            
+            cursor.execute('''
+                SELECT user_id, SUM(generations) AS generations, SUM(tokens_spent) AS tokens_spent
+                FROM daily_user_stats WHERE day >= ?
+                GROUP BY user_id ORDER BY tokens_spent DESC LIMIT ?
+            ''', (since_day, top))
+            users = [dict(row) for row in cursor.fetchall()]
+            
+            # Отставание сводок: id последних строк против водяных отметок
+            lag = {}
+            for source in ("images", "transactions"):
+                newest = cursor.execute(f"SELECT MAX(id) FROM {source}").fetchone()[0] or 0
+                lag[source] = newest - self._watermark(source)
+            
+            return {"days": days, "models": models, "users": users, "lag": lag}
+        except Exception as e:
+            logger.error(f"❌ İstatistik okunamadı: {e}")
+            return {"days": [], "models": [], "users": [], "lag": {}}
+    
+    def iter_export(self, kind: str, batch_size: int = 1000) -> Iterator[tuple]:
+        """Строки выгрузки kind из EXPORTS (первая - заголовок).
+        
+        Keyset-пагинация по первичному ключу: каждая пачка - отдельный
+        короткий SELECT, в памяти не больше batch_size строк, и долгая
+        выгрузка не держит открытую транзакцию чтения (WAL-чекпоинты идут).
+        """
+        table, columns, key = EXPORTS[kind]
+        yield columns
+        yield from self._iter_keyset(table, columns, key, batch_size)
+    
+    def _iter_keyset(self, table: str, columns: Tuple[str, ...], key: Tuple[str, ...],
+                     batch_size: int) -> Iterator[tuple]:
+        select = f"SELECT {', '.join(columns)} FROM {table}"
+        order = f" ORDER BY {', '.join(key)} LIMIT ?"
+        after = f" WHERE ({', '.join(key)}) > ({', '.join('?' * len(key))})"
+        key_index = [columns.index(name) for name in key]
+        
+        last = None
+        while True:
+            if last is None:
+                rows = self.conn.execute(select + order, (batch_size,)).fetchall()
+            else:
+                rows = self.conn.execute(select + after + order,
+                                         (*last, batch_size)).fetchall()
+            for row in rows:
+                yield tuple(row)
+            if len(rows) < batch_size:
+                return
+            last = [rows[-1][i] for i in key_index]
+    
+    # ========== РАЗДЕЛЫ ==========
+    def _rebuild_ledger_view(self, source: str):
+        """<source>_all = горячая таблица + разделы, ещё не ушедшие в архив"""
+        months = [row['month'] for row in self.conn.execute(
+            "SELECT month FROM ledger_partitions WHERE source = ? AND state != ? ORDER BY month",
+            (source, PARTITION_ARCHIVED)
+        )]
+        columns = ", ".join(name for name, _ in LEDGERS[source][1])
+        selects = [f"SELECT {columns} FROM {source}"] + [
+            f"SELECT {columns} FROM {partition_table(source, month)}" for month in months
+        ]
+        self.conn.execute(f"DROP VIEW IF EXISTS {source}_all")
+        self.conn.execute(f"CREATE VIEW {source}_all AS " + " UNION ALL ".join(selects))
+    
+    def partition_ledger(self, source: str, cutoff: str, batch_size: int = 5000) -> int:
+        """Перенести до batch_size строк старше cutoff ('YYYY-MM-DD') в помесячные таблицы.
+        
+        Переносятся только строки, уже учтённые в дневных сводках (id не выше
+        водяной отметки rollup_stats). Вставка в разделы, удаление из горячей
+        таблицы и обновление представления - одна транзакция.
+        Возвращает число перенесённых строк.
+        """
+        time_column, schema = LEDGERS[source]
+        columns = ", ".join(name for name, _ in schema)
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(f'''
+                SELECT MAX(id) AS upto, COUNT(*) AS size FROM (
+                    SELECT id FROM {source}
+                    WHERE id <= ? AND {time_column} < ?
+                    ORDER BY id LIMIT ?
+                )
+            ''', (self._watermark(source), cutoff, batch_size)).fetchone()
+            if not row['size']:
+                self.conn.rollback()
+                return 0
+            
+            selected = f"FROM {source} WHERE id <= ? AND {time_column} < ?"
+            params = (row['upto'], cutoff)
+            months = [r[0] for r in self.conn.execute(
+                f"SELECT DISTINCT strftime('%Y-%m', {time_column}) {selected}", params
+            )]
+            created = False
+            for month in months:
+                table = partition_table(source, month)
+                known = self.conn.execute(
+                    "SELECT state FROM ledger_partitions WHERE source = ? AND month = ?",
+                    (source, month)
+                ).fetchone()
+                # Новый месяц или уже архивированный (запоздавшие строки) - нужна таблица
+                if known is None or known['state'] != PARTITION_TABLE:
+                    definition = ", ".join(f"{name} {kind}" for name, kind in schema)
+                    self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({definition})")
+                    self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id "
+                                      f"ON {table} (user_id, id)")
+                    created = True
+                moved = self.conn.execute(
+                    f"INSERT INTO {table} ({columns}) SELECT {columns} {selected} "
+                    f"AND strftime('%Y-%m', {time_column}) = ?", (*params, month)
+                ).rowcount
+                self.conn.execute('''
+                    INSERT INTO ledger_partitions (source, month, state, rows)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (source, month) DO UPDATE SET
+                        rows = rows + excluded.rows, state = excluded.state
+                ''', (source, month, PARTITION_TABLE, moved))
+            
+            self.conn.execute(f"DELETE {selected}", params)
+            if created:
+                self._rebuild_ledger_view(source)
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"❌ Bölümleme hatası ({source}): {e}")
+            return 0
+        
+        logger.info(f"🗂 {source}: {row['size']} kayıt aylık bölümlere taşındı")
+        return row['size']
+    
+    def get_partitions(self, source: Optional[str] = None) -> List[dict]:
+        """Разделы из ledger_partitions (все или одного журнала)"""
+        try:
+            if source is None:
+                cursor = self.conn.execute("SELECT * FROM ledger_partitions ORDER BY source, month")
+            else:
+                cursor = self.conn.execute(
+                    "SELECT * FROM ledger_partitions WHERE source = ? ORDER BY month", (source,)
+                )
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ Bölümler okunamadı: {e}")
+            return []
+    
+    def iter_partition(self, source: str, month: str, batch_size: int = 1000) -> Iterator[dict]:
+        """Строки раздела по порядку (user_id, id) - для архивации"""
+        columns = tuple(name for name, _ in LEDGERS[source][1])
+        for row in self._iter_keyset(partition_table(source, month), columns,
+                                     ("user_id", "id"), batch_size):
+            yield dict(zip(columns, row))
+    
+    def begin_archive(self, source: str, month: str, data_name: str) -> Optional[str]:
+        """Пометить раздел как архивируемый; возвращает имя файла данных попытки.
+        
+        Если раздел уже в состоянии archiving (процесс упал между записью
+        архива и drop_partition), возвращается имя прежней попытки - по нему
+        видно, успел ли архив записаться. None - раздел уже в архиве.
+        """
+        try:
+            with self.conn:
+                updated = self.conn.execute('''
+                    UPDATE ledger_partitions SET state = ?, path = ?
+                    WHERE source = ? AND month = ? AND state = ?
+                ''', (PARTITION_ARCHIVING, data_name, source, month, PARTITION_TABLE)).rowcount
+            if updated:
+                return data_name
+            row = self.conn.execute(
+                "SELECT state, path FROM ledger_partitions WHERE source = ? AND month = ?",
+                (source, month)
+            ).fetchone()
+            return row['path'] if row and row['state'] == PARTITION_ARCHIVING else None
+        except Exception as e:
+            logger.error(f"❌ Arşivleme başlatılamadı ({source} {month}): {e}")
+            return None
+    
+    def drop_partition(self, source: str, month: str, path: str, data_name: str) -> bool:
+        """Раздел записан в архив path: удалить таблицу и убрать её из представления.
+        
+        data_name - попытка из begin_archive. Если за время записи в раздел
+        добавились запоздавшие строки (partition_ledger вернул состояние table),
+        таблица не удаляется - следующий проход заархивирует её заново.
+        """
+        table = partition_table(source, month)
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            updated = self.conn.execute('''
+                UPDATE ledger_partitions SET state = ?, path = ?
+                WHERE source = ? AND month = ? AND state = ? AND path = ?
+            ''', (PARTITION_ARCHIVED, path, source, month,
+                  PARTITION_ARCHIVING, data_name)).rowcount
+            if not updated:
+                # Другой процесс уже заархивировал раздел или пришли новые строки
+                self.conn.rollback()
+                return False
+            self._rebuild_ledger_view(source)
+            self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"❌ Bölüm silinemedi ({table}): {e}")
+            return False
+        logger.info(f"📦 {table} arşive taşındı: {path}")
+        return True
+    
+    def incremental_vacuum(self, pages: int = 1000) -> int:
+        """Вернуть ОС до pages свободных страниц; возвращает остаток свободных.
+        
+        База, созданная до auto_vacuum = INCREMENTAL, так не умеет: нужен
+        полный VACUUM (enable_incremental_vacuum) при остановленном боте.
+        Здесь он не запускается - перестройка большой базы надолго
+        заблокировала бы все записи.
+        """
+        try:
+            if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                if not Database._vacuum_warned:
+                    Database._vacuum_warned = True
+                    logger.warning("⚠️ Artımlı temizleme kapalı: bot durdurulmuşken "
+                                   "Database().enable_incremental_vacuum() çalıştırın")
+                return self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # execute() делает один шаг и освобождает одну страницу; executescript - все
+            self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            return self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        except Exception as e:
+            logger.error(f"❌ Artımlı temizleme hatası: {e}")
+            return -1
+    
+    def enable_incremental_vacuum(self):
+        """Разовый перевод старой базы на auto_vacuum = INCREMENTAL (полный VACUUM).
+        
+        Только офлайн: база перестраивается целиком, записи всё это время ждут.
+        """
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.execute("VACUUM")
+        logger.info("✅ Veritabanı artımlı temizleme moduna geçirildi")
+    
+    def get_storage_stats(self) -> dict:
+        """Размер файла базы и свободные страницы"""
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "bytes": self.conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+            "free_bytes": self.conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+        }
+    
+    # ========== СОСТОЯНИЯ ДИАЛОГА ==========
+    def save_conversation(self, user_id: int, state: str, data: str,
+                          expires_at: float) -> bool:
+        try:
+            with self.conn:
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO conversation_states (user_id, state, data, expires_at)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, state, data, expires_at))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Diyalog durumu kaydedilemedi: {e}")
+            return False
+    
+    def delete_conversation(self, user_id: int) -> bool:
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM conversation_states WHERE user_id = ?", (user_id,))
+            return True
+        except Exception as e:
+            logger.error(f"❌ Diyalog durumu silinemedi: {e}")
+            return False
+    
+    def load_conversations(self, now: float) -> List[dict]:
+        """Непросроченные состояния; просроченные удаляются"""
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM conversation_states WHERE expires_at <= ?", (now,))
+            cursor = self.conn.execute(
+                "SELECT user_id, state, data, expires_at FROM conversation_states"
+            )
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ Diyalog durumları okunamadı: {e}")
+            return []
+    
+    # ========== РАССЫЛКИ ==========
+    def create_broadcast(self, text: str) -> Optional[int]:
+        """Новая рассылка; None, если другая ещё идёт"""
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            running = self.conn.execute(
+                "SELECT id FROM broadcasts WHERE status = ? LIMIT 1", (BROADCAST_RUNNING,)
+            ).fetchone()
+            if running:
+                self.conn.rollback()
+                return None
+            total = self.conn.execute(
+                "SELECT COUNT(*) FROM users WHERE blocked_at IS NULL"
+            ).fetchone()[0]
+            broadcast_id = self.conn.execute('''
+                INSERT INTO broadcasts (text, status, total) VALUES (?, ?, ?)
+            ''', (text, BROADCAST_RUNNING, total)).lastrowid
             self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"❌ Duyuru oluşturulamadı: {e}")
+            return None
+        logger.info(f"📣 Duyuru #{broadcast_id} oluşturuldu: {total} alıcı")
+        return broadcast_id
+    
+    def get_broadcast(self, broadcast_id: Optional[int] = None) -> Optional[dict]:
+        """Рассылка по id (по умолчанию - последняя)"""
+        try:
+            if broadcast_id is None:
+                row = self.conn.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1").fetchone()
+            else:
+                row = self.conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"❌ Duyuru okunamadı: {e}")
+            return None
+    
+    def claim_broadcast(self, owner: str, lease_until: float, now: float) -> Optional[dict]:
+        """Взять идущую рассылку без владельца или с истёкшей арендой.
+    
+        Условие повторяется в UPDATE: из нескольких процессов (cluster.py)
+        рассылку получает только один.
+        """
+        try:
+            row = self.conn.execute('''
+                SELECT id FROM broadcasts
+                WHERE status = ? AND (owner IS NULL OR lease_until < ?)
+                ORDER BY id LIMIT 1
+            ''', (BROADCAST_RUNNING, now)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                claimed = self.conn.execute('''
+                    UPDATE broadcasts SET owner = ?, lease_until = ?
+                    WHERE id = ? AND status = ? AND (owner IS NULL OR lease_until < ?)
+                ''', (owner, lease_until, row['id'], BROADCAST_RUNNING, now)).rowcount
+            return self.get_broadcast(row['id']) if claimed else None
+        except Exception as e:
+            logger.error(f"❌ Duyuru alınamadı: {e}")
+            return None
+    
+    def get_broadcast_recipients(self, after_user_id: int, limit: int = 500) -> List[int]:
+        """Следующие получатели по первичному ключу (keyset), без заблокировавших"""
+        cursor = self.conn.execute('''
+            SELECT user_id FROM users
+            WHERE user_id > ? AND blocked_at IS NULL
+            ORDER BY user_id
+            LIMIT ?
+        ''', (after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+    
+    def checkpoint_broadcast(self, broadcast_id: int, owner: str, last_user_id: int,
+                             sent: int, failed: int, blocked_ids: List[int],
+                             lease_until: float) -> bool:
+        """Сохранить прогресс и отметить заблокировавших - одной транзакцией.
+    
+        Счётчики - приросты с прошлой отметки. False - рассылку отменили
+        или её забрал другой процесс: отправку нужно прекратить.
+        """
+        try:
+            with self.conn:
+                self.conn.executemany('''
+                    UPDATE users SET blocked_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND blocked_at IS NULL
+                ''', [(user_id,) for user_id in blocked_ids])
+                updated = self.conn.execute('''
+                    UPDATE broadcasts
+                    SET last_user_id = MAX(last_user_id, ?),
+                        sent = sent + ?,
+                        failed = failed + ?,
+                        blocked = blocked + ?,
+                        lease_until = ?
+                    WHERE id = ? AND owner = ? AND status = ?
+                ''', (last_user_id, sent, failed, len(blocked_ids), lease_until,
+                      broadcast_id, owner, BROADCAST_RUNNING)).rowcount
+            return bool(updated)
+        except Exception as e:
+            logger.error(f"❌ Duyuru ilerlemesi kaydedilemedi: {e}")
+            return False
+    
+    def finish_broadcast(self, broadcast_id: int, status: str) -> bool:
+        """Завершить (done) или отменить (cancelled) идущую рассылку"""
+        try:
+            with self.conn:
+                updated = self.conn.execute('''
+                    UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = ?
+                ''', (status, broadcast_id, BROADCAST_RUNNING)).rowcount
+            return bool(updated)
+        except Exception as e:
+            logger.error(f"❌ Duyuru kapatılamadı: {e}")
+            return False
+    
+    # ========== ПАКЕТНАЯ ЗАПИСЬ ==========
+    def write_batch(self, transactions: List[Tuple], images: List[Tuple],
+                    commits: List[Tuple[int, str]] = ()) -> bool:
+        """Записать пачку транзакций и изображений одним коммитом.
+        
+        commits - резервы (user_id, idempotency_key), подтверждаемые в той же
+        транзакции: генерация пишется одним коммитом вместе со списанием.
+        """
+        try:
+            with self.conn:
+                if transactions:
+                    self.conn.executemany('''
+                        INSERT INTO transactions (user_id, action, tokens_change, details)
+                        VALUES (?, ?, ?, ?)
+                    ''', transactions)
+                if images:
+                    self.conn.executemany('''
+                        INSERT INTO images (user_id, model, prompt, image_url, tokens_spent, content_hash)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', images)
+                if commits:
+                    self._commit_reservations(self.conn.cursor(), commits)
+            # На каждом сбросе буфера - только debug, это горячий путь
+            logger.debug(f"📝 Toplu kayıt: {len(transactions)} işlem, {len(images)} görsel, "
+                         f"{len(commits)} rezerv")
             return True
         except Exception as e:
-            logger.error(f"❌ Görsel kaydedilemedi: {e}")
+            logger.error(f"❌ Toplu kayıt hatası: {e}")
             return False
     
     def close(self):
@@ -1,32 +1,196 @@
 # gemini_generator.py
 import os
+import re
+import json
+import asyncio
 import logging
-import google.generativeai as genai
-from typing import Optional, Tuple
+import time
+import threading
+import importlib.util
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+from cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = """
+            Sen bir görsel oluşturma asistanısın. Kullanıcının basit açıklamasını 
+            detaylı, görsel oluşturucular için optimize edilmiş bir prompt'a dönüştür.
+            
+            Format:
+            1. Ana konu (Türkçe)
+            2. Stil (fotoğraf, dijital sanat, yağlı boya, vs.)
+            3. Renk paleti
+            4. Işık ve atmosfer
+            5. Ek detaylar
+            
+            Örnek:
+            Kullanıcı: "deniz manzarası"
+            Sen: "Akdeniz'de gün batımı, turkuaz deniz, altın rengi gökyüzü, 
+            kumsal, palmiye ağaçları, sıcak renkler, foto-gerçekçi, 8K kalite,
+            profesyonel fotoğrafçılık, doğal ışık, huzurlu atmosfer"
+            """
+
+# Пакетный запрос: системный промпт отправляется один раз на всю пачку
+BATCH_INSTRUCTIONS = """
+Aşağıda numaralandırılmış birden fazla kullanıcı açıklaması var.
+Her biri için yukarıdaki formatta ayrı bir detaylı prompt yaz.
+Yanıtı SADECE JSON dizisi olarak ver, başka metin ekleme:
+[{"id": 1, "prompt": "..."}, {"id": 2, "prompt": "..."}]
+"""
+
+def normalize_prompt(user_prompt: str) -> str:
+    """Ключ кэша: регистр, лишние пробелы и точка в конце не важны"""
+    return " ".join(user_prompt.casefold().split()).strip(" .!?")
+
+def parse_batch_response(text: str, count: int) -> List[Optional[str]]:
+    """Разобрать JSON-ответ пачки; для ненайденных пунктов - None"""
+    # Модель иногда оборачивает JSON в ```json ... ```
+    match = re.search(r"\[.*\]", text, re.DOTALL)
+    results: List[Optional[str]] = [None] * count
+    if not match:
+        return results
+    try:
+        items = json.loads(match.group(0))
+    except ValueError:
+        return results
+    
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get("id")
+        prompt = item.get("prompt")
+        if isinstance(index, int) and 1 <= index <= count and isinstance(prompt, str) and prompt.strip():
+            results[index - 1] = prompt.strip()
+    return results
+
+class PromptBatcher:
+    """Собирает промпты, пришедшие за короткое окно, в один запрос.
+    
+    Пачка уходит, когда набралось max_batch промптов или прошло
+    max_wait секунд с первого промпта. Каждый вызывающий получает
+    свой future; непонятые моделью пункты завершаются ошибкой.
+    """
+    
+    def __init__(self, send_batch: Callable[[List[str]], List[Optional[str]]],
+                 executor: Executor, max_batch: int = 8, max_wait: float = 0.05):
+        self.send_batch = send_batch
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches_sent = 0
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+    
+    def submit(self, user_prompt: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_prompt, future))
+        
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._send(batch))
+    
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        prompts = [prompt for prompt, _ in batch]
+        self.batches_sent += 1
+        try:
+            loop = asyncio.get_running_loop()
+            with metrics.GEMINI_LATENCY.time("batch"):
+                results = await loop.run_in_executor(self.executor, self.send_batch, prompts)
+        except Exception as e:
+            metrics.GEMINI_ERRORS.inc("batch")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (prompt, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if result is None:
+                future.set_exception(ValueError(f"batch item missing: {prompt[:30]}"))
+            else:
+                future.set_result(result)
+
 class GeminiGenerator:
     """Реальная генерация через Gemini API"""
     
-    def __init__(self):
+    def __init__(self, timeout: float = 8.0, cache_size: int = 1000,
+                 cache_ttl: float = 6 * 3600, batch_size: int = 8,
+                 batch_wait: float = 0.05):
+        # Улучшенные промпты: TTL + LRU, ключ - нормализованный промпт
+        self.timeout = timeout
+        self.prompt_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gemini")
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.batcher = PromptBatcher(self._enhance_batch, self._executor,
+                                     max_batch=batch_size, max_wait=batch_wait)
+        
+        # SDK google.generativeai тяжёлый - модель создаётся при первом запросе
+        self.model = None
+        self._model_lock = threading.Lock()
+        
         self.api_key = os.getenv("GEMINI_API_KEY")
         if not self.api_key:
-            logger.error("❌ GEMINI_API_KEY bulunamadı!")
+            # Улучшение промпта необязательно: без ключа промпт уходит как есть
+            logger.warning("⚠️ GEMINI_API_KEY yok, promptlar olduğu gibi kullanılacak")
             self.available = False
             return
-            
+        
+        # Наличие пакета проверяем без импорта
         try:
-            genai.configure(api_key=self.api_key)
-            # Gemini 1.5 Pro поддерживает генерацию изображений?
-            # Пока Gemini не генерирует изображения напрямую
-            # Но может создавать описания для других API
-            self.model = genai.GenerativeModel('gemini-1.5-pro')
-            self.available = True
-            logger.info("✅ Gemini API başlatıldı")
-        except Exception as e:
-            logger.error(f"❌ Gemini hatası: {e}")
+            self.available = importlib.util.find_spec("google.generativeai") is not None
+        except ModuleNotFoundError:
             self.available = False
+        if not self.available:
+            logger.error("❌ Gemini hatası: google-generativeai kurulu değil")
+    
+    def _get_model(self):
+        """Модель Gemini; импорт и настройка SDK - при первом вызове"""
+        if self.model is None:
+            with self._model_lock:
+                if self.model is None:
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)
+                    # Gemini 1.5 Pro поддерживает генерацию изображений?
+                    # Пока Gemini не генерирует изображения напрямую
+                    # Но может создавать описания для других API
+                    self.model = genai.GenerativeModel('gemini-1.5-pro')
+                    logger.info("✅ Gemini API başlatıldı")
+        return self.model
+    
+    def _enhance(self, user_prompt: str) -> str:
+        """Один запрос к Gemini (блокирующий, ошибки пробрасываются)"""
+        response = self._get_model().generate_content(
+            f"{SYSTEM_PROMPT}\n\nKullanıcı: {user_prompt}\n\nDetaylı prompt:"
+        )
+        return response.text.strip()
+    
+    def _enhance_batch(self, user_prompts: List[str]) -> List[Optional[str]]:
+        """Один запрос к Gemini на несколько промптов (блокирующий)"""
+        if len(user_prompts) == 1:
+            return [self._enhance(user_prompts[0])]
+        
+        numbered = "\n".join(f"{i}. {prompt}" for i, prompt in enumerate(user_prompts, 1))
+        response = self._get_model().generate_content(
+            f"{SYSTEM_PROMPT}\n{BATCH_INSTRUCTIONS}\nKullanıcı açıklamaları:\n{numbered}"
+        )
+        results = parse_batch_response(response.text, len(user_prompts))
+        logger.info(f"✅ Gemini toplu prompt: {sum(r is not None for r in results)}/{len(user_prompts)}")
+        return results
     
     def generate_image_prompt(self, user_prompt: str) -> str:
         """Создать детальный промпт для генерации изображения"""
@@ -34,38 +198,66 @@ class GeminiGenerator:
             return user_prompt
         
         try:
-            system_prompt = """
-            Sen bir görsel oluşturma asistanısın. Kullanıcının basit açıklamasını 
-            detaylı, görsel oluşturucular için optimize edilmiş bir prompt'a dönüştür.
-            
-            Format:
-            1. Ana konu (Türkçe)
-            2. Stil (fotoğraf, dijital sanat, yağlı boya, vs.)
-            3. Renk paleti
-            4. Işık ve atmosfer
-            5. Ek detaylar
-            
-            Örnek:
-            Kullanıcı: "deniz manzarası"
-            Sen: "Akdeniz'de gün batımı, turkuaz deniz, altın rengi gökyüzü, 
-            kumsal, palmiye ağaçları, sıcak renkler, foto-gerçekçi, 8K kalite, 
-            profesyonel fotoğrafçılık, doğal ışık, huzurlu atmosfer"
-            """
-            
-            response = self.model.generate_content(
-                f"{system_prompt}\n\nKullanıcı: {user_prompt}\n\nDetaylı prompt:"
-            )
-            
-            detailed_prompt = response.text.strip()
+            detailed_prompt = self._enhance(user_prompt)
             logger.info(f"✅ Gemini prompt: {detailed_prompt[:100]}...")
             return detailed_prompt
-            
+        
+        except Exception as e:
+            logger.error(f"❌ Gemini prompt hatası: {e}")
+            return user_prompt
+    
+    async def agenerate_image_prompt(self, user_prompt: str,
+                                     timeout: Optional[float] = None) -> str:
+        """Асинхронная версия: кэш, пакетные запросы и жёсткий дедлайн.
+        
+        Если Gemini не ответил за timeout секунд или вернул ошибку,
+        возвращается исходный промпт. Одинаковые запросы, пришедшие
+        одновременно, ждут один и тот же вызов.
+        """
+        if not self.available:
+            return user_prompt
+        
+        key = normalize_prompt(user_prompt)
+        cached = self.prompt_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        future = self._inflight.get(key)
+        if future is None:
+            # Промпт уходит в ближайшую пачку батчера
+            future = self.batcher.submit(user_prompt)
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._store(key, f))
+        
+        started = time.perf_counter()
+        try:
+            # shield: таймаут одного ждущего не отменяет общий вызов
+            return await asyncio.wait_for(asyncio.shield(future),
+                                          timeout or self.timeout)
+        except asyncio.TimeoutError:
+            metrics.GEMINI_ERRORS.inc("timeout")
+            logger.warning(f"⚠️ Gemini zaman aşımı, ham prompt kullanılıyor: {user_prompt[:30]}")
+            return user_prompt
         except Exception as e:
+            metrics.GEMINI_ERRORS.inc("request")
             logger.error(f"❌ Gemini prompt hatası: {e}")
             return user_prompt
+        finally:
+            metrics.GEMINI_LATENCY.observe(time.perf_counter() - started, "request")
+    
+    def _store(self, key: str, future: asyncio.Future):
+        """Положить успешный ответ в кэш (ошибки не кэшируем)"""
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        detailed_prompt = future.result()
+        self.prompt_cache.put(key, detailed_prompt)
+        logger.info(f"✅ Gemini prompt: {detailed_prompt[:100]}...")
     
     def is_available(self) -> bool:
         return self.available
 
 # Глобальный инстанс
 gemini_gen = GeminiGenerator()
+metrics.CACHE_HIT_RATE.set_function(
+    lambda: gemini_gen.prompt_cache.stats()["hit_rate"], "gemini_prompts")
@@ -0,0 +1,244 @@
+# image_store.py - ЛОКАЛЬНОЕ ХРАНИЛИЩЕ ИЗОБРАЖЕНИЙ
+"""Контент-адресуемое хранилище сгенерированных изображений на диске.
+
+    images/ab/ab12...ef.img        - оригинал (имя - sha256 содержимого)
+    images/ab/ab12...ef.thumb.jpg  - превью (если установлен Pillow)
+
+Скачивание потоковое: куски пишутся во временный файл (в потоке, пачками
+до write_buffer байт), хэш считается на лету, целиком файл в памяти не
+держится. По окончании файл переименовывается в путь по хэшу; одинаковые
+картинки хранятся один раз. При превышении
+max_bytes удаляются давно не использованные (LRU по времени доступа,
+переживает перезапуск через mtime); файлы, открытые для отправки, не
+удаляются.
+"""
+import os
+import asyncio
+import contextlib
+import hashlib
+import logging
+import tempfile
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, BinaryIO, List, NamedTuple, Optional, Tuple
+
+from cache import LRUCache
+from providers import HTTPPool
+
+try:
+    from PIL import Image
+except ImportError:  # превью необязательны
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+ORIGINAL_SUFFIX = ".img"
+THUMB_SUFFIX = ".thumb.jpg"
+
+class StoredImage(NamedTuple):
+    digest: str
+    path: str
+    thumb_path: Optional[str]
+    size: int
+
+class ImageTooLarge(Exception):
+    pass
+
+class ImageStore:
+    def __init__(self, root: str, pool: HTTPPool, max_bytes: int = 512 * 1024 * 1024,
+                 max_image_bytes: int = 20 * 1024 * 1024, thumb_size: int = 256,
+                 chunk_size: int = 64 * 1024, write_buffer: int = 1024 * 1024,
+                 timeout: float = 15.0):
+        self.root = root
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.thumb_size = thumb_size
+        self.chunk_size = chunk_size
+        self.write_buffer = write_buffer
+        self.timeout = timeout
+        # digest -> байт на диске (оригинал + превью), порядок - LRU
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        # digest -> сколько чтений идёт сейчас (такие записи не вытесняются)
+        self._reading: Counter = Counter()
+        # URL -> digest: повторная отправка того же URL без скачивания
+        self._urls = LRUCache(maxsize=10000)
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    # ========== ПУТИ ==========
+    def _path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + suffix)
+
+    def _stored(self, digest: str) -> StoredImage:
+        thumb = self._path(digest, THUMB_SUFFIX)
+        return StoredImage(digest, self._path(digest, ORIGINAL_SUFFIX),
+                           thumb if os.path.exists(thumb) else None,
+                           self._entries.get(digest, 0))
+
+    # ========== ИНДЕКС ==========
+    def _scan(self):
+        """Восстановить LRU-индекс с диска (в потоке, при первом обращении)"""
+        found = []
+        os.makedirs(self.root, exist_ok=True)
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.endswith(".tmp"):
+                    # Недокачанный файл с прошлого запуска
+                    os.remove(path)
+                    continue
+                if not name.endswith(ORIGINAL_SUFFIX):
+                    continue
+                digest = name[:-len(ORIGINAL_SUFFIX)]
+                stat = os.stat(path)
+                size = stat.st_size
+                thumb = self._path(digest, THUMB_SUFFIX)
+                if os.path.exists(thumb):
+                    size += os.path.getsize(thumb)
+                found.append((stat.st_mtime, digest, size))
+
+        for _, digest, size in sorted(found):
+            self._entries[digest] = size
+            self.total_bytes += size
+        logger.info(f"✅ 🖼 Görsel deposu: {len(self._entries)} dosya, "
+                    f"{self.total_bytes / 1024 / 1024:.1f} MB")
+
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            async with self._lock:
+                if not self._loaded:
+                    await asyncio.to_thread(self._scan)
+                    self._loaded = True
+
+    def _touch(self, digest: str):
+        self._entries.move_to_end(digest)
+        try:
+            os.utime(self._path(digest, ORIGINAL_SUFFIX))
+        except OSError:
+            pass
+
+    def _pick_victims(self) -> List[str]:
+        """Самые старые записи сверх max_bytes (индекс меняется только в event loop)"""
+        victims = []
+        for digest in list(self._entries):
+            if self.total_bytes <= self.max_bytes or len(self._entries) <= 1:
+                break
+            if digest in self._reading:
+                continue
+            self.total_bytes -= self._entries.pop(digest)
+            victims.append(digest)
+        return victims
+
+    def _remove_files(self, digests: List[str]):
+        for digest in digests:
+            for suffix in (ORIGINAL_SUFFIX, THUMB_SUFFIX):
+                try:
+                    os.remove(self._path(digest, suffix))
+                except FileNotFoundError:
+                    pass
+        logger.info(f"🗑 Görsel deposundan silindi (LRU): {len(digests)} dosya")
+
+    # ========== ЗАПИСЬ ==========
+    async def _download(self, url: str) -> Tuple[str, str]:
+        """Скачать во временный файл; возвращает (digest, путь к временному файлу)"""
+        digest = hashlib.sha256()
+        size = 0
+        # Куски копятся до write_buffer байт: один переход в поток на пачку, не на кусок
+        buffered: List[bytes] = []
+        buffered_size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with self.pool.client().stream("GET", url, timeout=self.timeout,
+                                                     follow_redirects=True) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_image_bytes:
+                            raise ImageTooLarge(f"{size} bayt > {self.max_image_bytes}")
+                        digest.update(chunk)
+                        buffered.append(chunk)
+                        buffered_size += len(chunk)
+                        if buffered_size >= self.write_buffer:
+                            await asyncio.to_thread(f.writelines, buffered)
+                            buffered, buffered_size = [], 0
+                if buffered:
+                    await asyncio.to_thread(f.writelines, buffered)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return digest.hexdigest(), tmp_path
+
+    def _commit(self, digest: str, tmp_path: str) -> int:
+        """Переместить файл на место, сделать превью; возвращает размер (в потоке)"""
+        path = self._path(digest, ORIGINAL_SUFFIX)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        if Image is not None:
+            thumb = self._path(digest, THUMB_SUFFIX)
+            try:
+                with Image.open(path) as image:
+                    image.thumbnail((self.thumb_size, self.thumb_size))
+                    image.convert("RGB").save(thumb, "JPEG", quality=80)
+                size += os.path.getsize(thumb)
+            except Exception as e:
+                logger.warning(f"⚠️ Önizleme oluşturulamadı ({digest[:12]}): {e}")
+        return size
+
+    async def fetch(self, url: str) -> StoredImage:
+        """Локальная копия изображения по URL (скачивается при первом запросе)"""
+        await self._ensure_loaded()
+
+        digest = self._urls.get(url)
+        if digest is not None and digest in self._entries:
+            self._touch(digest)
+            return self._stored(digest)
+
+        digest, tmp_path = await self._download(url)
+        if digest in self._entries:
+            # Та же картинка уже есть под другим URL
+            os.remove(tmp_path)
+            self._touch(digest)
+        else:
+            size = await asyncio.to_thread(self._commit, digest, tmp_path)
+            # Пока шёл _commit, ту же картинку мог добавить параллельный запрос
+            if digest not in self._entries:
+                self._entries[digest] = size
+                self.total_bytes += size
+            victims = self._pick_victims()
+            if victims:
+                await asyncio.to_thread(self._remove_files, victims)
+        self._urls.put(url, digest)
+        return self._stored(digest)
+
+    @contextlib.asynccontextmanager
+    async def open(self, digest: str) -> AsyncIterator[Optional[BinaryIO]]:
+        """Открытый оригинал (None - уже вытеснен); пока открыт, не вытесняется"""
+        if digest not in self._entries:
+            yield None
+            return
+        self._reading[digest] += 1
+        try:
+            try:
+                f = await asyncio.to_thread(open, self._path(digest, ORIGINAL_SUFFIX), "rb")
+            except FileNotFoundError:
+                yield None
+                return
+            try:
+                yield f
+            finally:
+                f.close()
+        finally:
+            self._reading[digest] -= 1
+            if not self._reading[digest]:
+                del self._reading[digest]
+
+    def get(self, digest: str) -> Optional[StoredImage]:
+        """Уже сохранённое изображение по хэшу (для галереи и повторной отправки)"""
+        if digest not in self._entries:
+            return None
+        self._touch(digest)
+        return self._stored(digest)
@@ -0,0 +1,89 @@
+# media_cache.py - КЭШ FILE_ID TELEGRAM
+import logging
+from typing import Optional
+
+from telegram import Message
+from telegram.error import BadRequest
+
+from async_db import AsyncDatabase
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых сохранённый file_id больше не годится
+FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier",
+                  "file reference expired", "wrong padding",
+                  "can't use file of type")
+
+def content_key(digest: str) -> str:
+    """Ключ для изображений без постоянного URL - sha256 содержимого (hex)"""
+    return "sha256:" + digest
+
+class FileIdCache:
+    """Кэш (URL или хэш содержимого) -> file_id Telegram.
+
+    После первой отправки Telegram хранит файл у себя; повторная
+    отправка по file_id не заставляет его заново скачивать источник.
+    Спереди - LRU в памяти, сзади - таблица telegram_files.
+    """
+
+    def __init__(self, db: AsyncDatabase, maxsize: int = 5000):
+        self.db = db
+        self.memory = LRUCache(maxsize=maxsize)
+
+    async def get(self, source_key: str) -> Optional[str]:
+        file_id = self.memory.get(source_key)
+        if file_id is None:
+            file_id = await self.db.get_file_id(source_key)
+            if file_id:
+                self.memory.put(source_key, file_id)
+        return file_id
+
+    async def put(self, source_key: str, file_id: str):
+        self.memory.put(source_key, file_id)
+        await self.db.save_file_id(source_key, file_id)
+
+    async def forget(self, source_key: str):
+        self.memory.pop(source_key)
+        await self.db.save_file_id(source_key, "")
+
+    async def reply_cached(self, message: Message, source_key: str,
+                           **kwargs) -> Optional[Message]:
+        """Отправить по сохранённому file_id; None - file_id нет (или он устарел)"""
+        file_id = await self.get(source_key)
+        if not file_id:
+            return None
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            # Прочие ошибки (подпись, разметка) - не повод забывать file_id
+            if not any(error in str(e).lower() for error in FILE_ID_ERRORS):
+                raise
+            # file_id устарел или от другого бота - отправим заново
+            logger.warning(f"⚠️ file_id geçersiz ({source_key[:40]}): {e}")
+            await self.forget(source_key)
+            return None
+
+    async def upload(self, message: Message, photo, source_key: Optional[str] = None,
+                     **kwargs) -> Message:
+        """Отправить сам файл (или URL) и запомнить полученный file_id"""
+        sent = await message.reply_photo(photo=photo, **kwargs)
+        if source_key and sent.photo:
+            # Самый большой размер - последний в списке
+            await self.put(source_key, sent.photo[-1].file_id)
+        return sent
+
+    async def reply_photo(self, message: Message, photo, source_key: Optional[str] = None,
+                          **kwargs) -> Message:
+        """reply_photo, который по возможности отправляет file_id.
+
+        photo - URL или файл; source_key по умолчанию - сам URL.
+        """
+        if source_key is None and isinstance(photo, str):
+            source_key = photo
+
+        if source_key:
+            sent = await self.reply_cached(message, source_key, **kwargs)
+            if sent is not None:
+                return sent
+        return await self.upload(message, photo, source_key, **kwargs)
@@ -0,0 +1,212 @@
+# metrics.py - МЕТРИКИ В ФОРМАТЕ PROMETHEUS
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _HistogramChild:
+    """Значения одной комбинации меток: счётчики корзин, сумма, количество"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # Без блокировок: записи идут из event loop, под GIL
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram:
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._children: Dict[Tuple[str, ...], _HistogramChild] = {}
+
+    def labels(self, *values: str) -> _HistogramChild:
+        """Дочерняя серия; её можно сохранить и вызывать observe без поиска"""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float, *labels: str):
+        self.labels(*labels).observe(value)
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self.labels(*labels))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, child in sorted(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {child.count}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {child.sum}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+class _Timer:
+    """with HISTOGRAM.time(...): - замер длительности блока"""
+    __slots__ = ("child", "started")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+
+class Counter:
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = description
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {value}")
+        return lines
+
+class Gauge:
+    """Значение, которое читается функцией в момент запроса /metrics"""
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = description
+        self.labelnames = tuple(labelnames)
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], *labels: str):
+        self._functions[labels] = function
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for values, function in sorted(self._functions.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {value}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# ========== МЕТРИКИ БОТА ==========
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Update handler latency", ["handler"]))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total", "Update handler exceptions", ["handler"]))
+DB_LATENCY = REGISTRY.register(Histogram(
+    "bot_db_seconds", "Database method latency (including executor wait)", ["method"]))
+DB_ERRORS = REGISTRY.register(Counter(
+    "bot_db_errors_total", "Database method exceptions", ["method"]))
+GENERATION_LATENCY = REGISTRY.register(Histogram(
+    "bot_generation_seconds", "Image generator latency", ["model"]))
+GENERATION_ERRORS = REGISTRY.register(Counter(
+    "bot_generation_errors_total", "Image generator errors", ["model"]))
+GEMINI_LATENCY = REGISTRY.register(Histogram(
+    "bot_gemini_seconds", "Gemini prompt enhancement latency", ["kind"]))
+GEMINI_ERRORS = REGISTRY.register(Counter(
+    "bot_gemini_errors_total", "Gemini errors and timeouts", ["kind"]))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "bot_queue_depth", "Items waiting in internal queues", ["queue"]))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "bot_in_flight", "Items being processed right now", ["queue"]))
+CACHE_HIT_RATE = REGISTRY.register(Gauge(
+    "bot_cache_hit_ratio", "Cache hit ratio", ["cache"]))
+PROVIDER_LIMIT = REGISTRY.register(Gauge(
+    "bot_provider_concurrency_limit", "Adaptive concurrency limit per image model", ["model"]))
+PROVIDER_CIRCUIT_OPEN = REGISTRY.register(Gauge(
+    "bot_provider_circuit_open", "1 while the model's circuit breaker is not closed", ["model"]))
+OUTBOUND_WAIT = REGISTRY.register(Histogram(
+    "bot_outbound_wait_seconds", "Time a Telegram API request waited for pacing", ["priority"]))
+OUTBOUND_EVENTS = REGISTRY.register(Counter(
+    "bot_outbound_events_total", "Outbound scheduler events (retry_after, coalesced)", ["event"]))
+
+def callback_branch(data: Optional[str]) -> str:
+    """callback_data без курсоров/идентификаторов: history_older_15 -> history_older"""
+    if not data:
+        return "unknown"
+    return data.rstrip("0123456789").rstrip("_") or "unknown"
+
+# ========== HTTP ==========
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # Заголовки не нужны - просто дочитываем их
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.split()
+        path = parts[1].split(b"?")[0] if len(parts) >= 2 else b""
+        if parts and parts[0] == b"GET" and path == b"/metrics":
+            status, body = "200 OK", REGISTRY.render().encode()
+        elif parts and parts[0] == b"GET" and path == b"/healthz":
+            status, body = "200 OK", b"ok\n"
+        else:
+            status, body = "404 Not Found", b"not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"⚠️ Metrik isteği hatası: {e}")
+    finally:
+        writer.close()
+
+async def start_http_server(port: int, host: str = "0.0.0.0") -> asyncio.AbstractServer:
+    """Поднять HTTP-сервер с /metrics и /healthz"""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info(f"✅ 📈 Metrikler: http://{host}:{port}/metrics")
+    return server
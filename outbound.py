@@ -0,0 +1,257 @@
+# outbound.py - ОЧЕРЕДЬ ИСХОДЯЩИХ ЗАПРОСОВ К TELEGRAM
+"""Планировщик исходящих запросов Bot API (Application.builder().rate_limiter).
+
+Все вызовы бота (reply_text, edit_message_text, reply_photo, delete...)
+проходят через process_request:
+
+- темп по чату: в личном чате около 1 сообщения в секунду с небольшим
+  запасом на всплеск, в группах - 20 в минуту (GCRA: место в очереди
+  чата резервируется сразу, порядок сообщений чата сохраняется);
+- общий темп бота (около 30 запросов в секунду) - корзина токенов,
+  ожидающие запросы выходят по приоритету: ответы на callback раньше
+  обычных сообщений, массовые рассылки (rate_limit_args=PRIORITY_BULK) - последними;
+- несколько ожидающих правок одного сообщения (например, место в очереди
+  в processing_msg) сливаются: уходит только последняя, все вызовы
+  получают её результат;
+- RetryAfter (429) приостанавливает на retry_after секунд только чат,
+  в который он пришёл; весь бот - если у запроса нет чата или за
+  flood_window секунд 429 пришли в flood_chats разных чатов (общий лимит).
+  Затем запрос повторяется (не больше max_retries раз);
+- платные рассылки (allow_paid_broadcast) не входят в общий темп бота,
+  у них свой лимит paid_rate.
+"""
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты (меньше - раньше)
+PRIORITY_URGENT = 0     # answerCallbackQuery: кнопка "крутится", пока нет ответа
+PRIORITY_NORMAL = 1     # ответы пользователю
+PRIORITY_BULK = 2       # рассылки
+
+# Правки, которые можно слить в последнюю
+COALESCED_EDITS = {"editMessageText", "editMessageCaption",
+                   "editMessageReplyMarkup", "editMessageMedia"}
+
+class _ChatPace:
+    """GCRA: не чаще rate в секунду, всплеск до burst запросов"""
+    __slots__ = ("interval", "tolerance", "tat")
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.tat = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Зарезервировать место; возвращает, сколько секунд ждать"""
+        tat = max(self.tat, now)
+        self.tat = tat + self.interval
+        return max(0.0, tat - self.tolerance - now)
+
+    def pause(self, until: float):
+        self.tat = max(self.tat, until + self.tolerance)
+
+class _Edit:
+    """Ожидающая правка сообщения; новые правки подменяют её аргументы"""
+    __slots__ = ("callback", "args", "kwargs", "future", "started")
+
+    def __init__(self, callback, args, kwargs):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.started = False
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    def __init__(self, global_rate: Tuple[float, float] = (25.0, 5),
+                 private_rate: Tuple[float, int] = (1.0, 3),
+                 group_rate: Tuple[float, int] = (20 / 60, 3),
+                 paid_rate: Tuple[float, int] = (1000.0, 100),
+                 max_retries: int = 3, max_chats: int = 100000,
+                 flood_chats: int = 3, flood_window: float = 1.0):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.flood_chats = flood_chats
+        self.flood_window = flood_window
+        self._global = TokenBucket(*global_rate, time.monotonic())
+        self._paid = _ChatPace(*paid_rate)
+        self._paused_until = 0.0
+        # chat_id -> время последнего RetryAfter (для распознавания общего лимита)
+        self._flooded: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._chats: "OrderedDict[Hashable, _ChatPace]" = OrderedDict()
+        self._edits: Dict[Hashable, _Edit] = {}
+        # (приоритет, номер, future) - ждут общий токен
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    # ========== ЗАПУСК / ОСТАНОВКА ==========
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch(), name="outbound")
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    @property
+    def queued(self) -> int:
+        """Запросов ждут общий токен"""
+        return len(self._waiters)
+
+    # ========== ТЕМП ==========
+    def _chat(self, chat_id: Hashable) -> _ChatPace:
+        pace = self._chats.get(chat_id)
+        if pace is None:
+            group = isinstance(chat_id, str) or chat_id < 0
+            pace = self._chats[chat_id] = _ChatPace(*(self.group_rate if group else self.private_rate))
+            # Давно не писавшие чаты - в начале словаря
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return pace
+
+    async def _global_slot(self, priority: int):
+        now = time.monotonic()
+        if not self._waiters and now >= self._paused_until and self._global.consume(1, now):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        """Выдаёт общие токены ожидающим по приоритету"""
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if not self._global.consume(1, now):
+                await asyncio.sleep((1 - self._global.tokens) / self._global.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Запрос отменён, пока ждал - токен не потрачен
+                self._global.tokens += 1
+            else:
+                future.set_result(None)
+
+    async def _acquire(self, chat_id: Optional[Hashable], priority: int, paid: bool = False):
+        started = time.monotonic()
+        if chat_id is not None:
+            delay = self._chat(chat_id).reserve(started)
+            if delay:
+                await asyncio.sleep(delay)
+        if paid:
+            # Свой темп, место резервируется сразу - порядок очереди сохраняется
+            delay = self._paid.reserve(time.monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+        else:
+            await self._global_slot(priority)
+        metrics.OUTBOUND_WAIT.observe(time.monotonic() - started, str(priority))
+
+    def _pause(self, chat_id: Optional[Hashable], retry_after: float):
+        now = time.monotonic()
+        until = now + retry_after
+        if chat_id is not None:
+            self._chat(chat_id).pause(until)
+            self._flooded[chat_id] = now
+            self._flooded.move_to_end(chat_id)
+            while self._flooded and next(iter(self._flooded.values())) < now - self.flood_window:
+                self._flooded.popitem(last=False)
+            if len(self._flooded) < self.flood_chats:
+                return
+            logger.warning(f"⚠️ Telegram genel limiti: {len(self._flooded)} sohbette 429")
+        self._paused_until = max(self._paused_until, until)
+
+    # ========== ЗАПРОСЫ ==========
+    async def process_request(self, callback: Callable, args: Any, kwargs: Dict[str, Any],
+                              endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: Optional[int]):
+        chat_id = data.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif endpoint == "answerCallbackQuery":
+            priority = PRIORITY_URGENT
+        else:
+            priority = PRIORITY_NORMAL
+        paid = bool(data.get("allow_paid_broadcast"))
+
+        key = None
+        if endpoint in COALESCED_EDITS:
+            key = (endpoint, chat_id, data.get("message_id"), data.get("inline_message_id"))
+            pending = self._edits.get(key)
+            if pending is not None and not pending.started:
+                # Ещё не отправлена - отправится уже с новым текстом
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                metrics.OUTBOUND_EVENTS.inc("coalesced")
+                return await asyncio.shield(pending.future)
+
+        edit = _Edit(callback, args, kwargs) if key else None
+        if edit:
+            self._edits[key] = edit
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self._acquire(chat_id, priority, paid)
+                if edit:
+                    # Дальше правка уходит как есть; новые - отдельным запросом
+                    edit.started = True
+                    if self._edits.get(key) is edit:
+                        del self._edits[key]
+                    callback, args, kwargs = edit.callback, edit.args, edit.kwargs
+                try:
+                    result = await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    metrics.OUTBOUND_EVENTS.inc("retry_after")
+                    if attempt == self.max_retries:
+                        raise
+                    logger.warning(f"⚠️ Telegram limiti ({endpoint}, chat {chat_id}): "
+                                   f"{e.retry_after} sn bekleniyor")
+                    self._pause(chat_id, float(e.retry_after) + 0.1)
+                    continue
+                if edit:
+                    edit.future.set_result(result)
+                return result
+        except BaseException as e:
+            if edit and not edit.future.done():
+                if isinstance(e, asyncio.CancelledError):
+                    edit.future.cancel()
+                else:
+                    edit.future.set_exception(e)
+                    # Ошибку получат слитые вызовы; у самого запроса - raise ниже
+                    edit.future.exception()
+            raise
+        finally:
+            if edit and self._edits.get(key) is edit:
+                del self._edits[key]
@@ -0,0 +1,88 @@
+# post_update.py - СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ДЛЯ WEBHOOK-РЕЖИМА
+"""Отправить синтетические апдейты на локальный webhook бота.
+
+Пример:
+    python post_update.py --secret $WEBHOOK_SECRET --text "/start" --count 100
+    python post_update.py --secret $WEBHOOK_SECRET --callback balance --users 20
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+import httpx
+
+_update_ids = itertools.count(int(time.time()) * 1000)
+
+def make_update(user_id: int, text: str = None, callback: str = None) -> dict:
+    """Минимальный апдейт Telegram (сообщение или нажатие кнопки)"""
+    update_id = next(_update_ids)
+    user = {"id": user_id, "is_bot": False, "first_name": f"Test{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+
+    if callback is not None:
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": user,
+                "chat_instance": str(user_id),
+                "data": callback,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": chat,
+                    "text": "menu",
+                },
+            },
+        }
+
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": chat,
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+        ]
+    return {"update_id": update_id, "message": message}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", required=True, help="WEBHOOK_SECRET бота")
+    parser.add_argument("--text", default="/start")
+    parser.add_argument("--callback", default=None, help="callback_data вместо текста")
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--count", type=int, default=1, help="апдейтов на пользователя")
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    statuses = {}
+
+    async with httpx.AsyncClient(headers=headers, timeout=10) as client:
+        async def post(user_id: int):
+            async with semaphore:
+                update = make_update(user_id, text=args.text, callback=args.callback)
+                response = await client.post(args.url, json=update)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            post(1000 + user)
+            for user in range(args.users)
+            for _ in range(args.count)
+        ))
+        elapsed = time.perf_counter() - started
+
+    total = args.users * args.count
+    print(f"{total} apdeyt, {elapsed:.2f} sn, {total / elapsed:.0f} apdeyt/sn")
+    print(f"HTTP durumları: {statuses}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
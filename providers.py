@@ -0,0 +1,232 @@
+# providers.py - РЕЕСТР ПРОВАЙДЕРОВ ИЗОБРАЖЕНИЙ
+"""Модели генерации изображений за общим асинхронным интерфейсом.
+
+Каждая модель из Config.IMAGE_PROVIDERS - адаптер с методом
+generate(prompt). HTTP-адаптеры используют один общий httpx.AsyncClient
+(keep-alive пул соединений), а не открывают соединение на запрос;
+у каждого адаптера свой таймаут, адаптивный (AIMD) лимит одновременных
+запросов и предохранитель; registry.generate переключается на запасные
+модели из Config.IMAGE_FALLBACKS.
+
+Без IMAGE_API_URL все модели работают в демо-режиме (image_gen).
+Для проверки без внешних API: python stub_server.py и
+IMAGE_API_URL=http://127.0.0.1:8090.
+"""
+import os
+import asyncio
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+import metrics
+from config import Config
+from image_generator import image_gen
+from resilience import AdaptiveLimiter, CircuitBreaker, Unavailable
+
+logger = logging.getLogger(__name__)
+
+class ProviderError(Exception):
+    """Провайдер не вернул изображение"""
+
+class ImageResult(NamedTuple):
+    url: str
+    tokens: int
+    # Предупреждение для пользователя (демо-режим и т.п.)
+    note: Optional[str] = None
+
+# ========== ОБЩИЙ HTTP-ПУЛ ==========
+class HTTPPool:
+    """Один httpx.AsyncClient на процесс; создаётся при первом запросе"""
+
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20,
+                 keepalive_expiry: float = 30.0):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self.limits)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# ========== АДАПТЕРЫ ==========
+class ImageProvider:
+    """Базовый адаптер: цена из Config.PRICES, AIMD-лимит и предохранитель"""
+
+    def __init__(self, model: str, title: str, max_connections: int = 8,
+                 timeout: float = 30.0, latency_target: float = 10.0,
+                 hedge_after: Optional[float] = None):
+        self.model = model
+        self.title = title
+        self.price = Config.PRICES[model]
+        self.timeout = timeout
+        # Не ответил за hedge_after - параллельно пробуем запасную модель
+        self.hedge_after = hedge_after
+        self.limiter = AdaptiveLimiter(max_limit=max_connections,
+                                       latency_target=latency_target)
+        self.breaker = CircuitBreaker(model, failures=Config.CIRCUIT_FAILURES,
+                                      reset_timeout=Config.CIRCUIT_RESET)
+
+    async def generate(self, prompt: str) -> ImageResult:
+        """Запрос к модели; Unavailable - отказ сразу, без обращения к API"""
+        if not self.breaker.allow():
+            raise Unavailable(f"{self.model}: devre açık")
+        try:
+            async with self.limiter.slot():
+                result = await asyncio.wait_for(self._generate(prompt), self.timeout)
+        except (Unavailable, asyncio.CancelledError):
+            # Запрос до API не дошёл или проиграл хедж - здоровье не известно
+            self.breaker.record_cancel()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _generate(self, prompt: str) -> ImageResult:
+        raise NotImplementedError
+
+class DemoProvider(ImageProvider):
+    """Демо: случайная картинка Unsplash из image_gen"""
+
+    async def _generate(self, prompt: str) -> ImageResult:
+        image_url, _, note = image_gen.generate_image(prompt=prompt, model_type=self.model)
+        return ImageResult(image_url, self.price, note)
+
+class HTTPProvider(ImageProvider):
+    """JSON API: POST {base_url}/v1/images {"model", "prompt"} -> {"url"}"""
+
+    def __init__(self, model: str, title: str, base_url: str, pool: HTTPPool,
+                 api_key: Optional[str] = None, **kwargs):
+        super().__init__(model, title, **kwargs)
+        self.url = f"{base_url.rstrip('/')}/v1/images"
+        self.pool = pool
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+
+    async def _generate(self, prompt: str) -> ImageResult:
+        try:
+            response = await self.pool.client().post(
+                self.url,
+                json={"model": self.model, "prompt": prompt},
+                headers=self.headers,
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            return ImageResult(response.json()["url"], self.price)
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            raise ProviderError(f"{self.model}: {e}") from e
+
+# ========== РЕЕСТР ==========
+class ProviderRegistry:
+    def __init__(self, pool: HTTPPool):
+        self.pool = pool
+        self._providers: Dict[str, ImageProvider] = {}
+
+    def register(self, provider: ImageProvider) -> ImageProvider:
+        self._providers[provider.model] = provider
+        return provider
+
+    def get(self, model: str) -> ImageProvider:
+        try:
+            return self._providers[model]
+        except KeyError:
+            raise ProviderError(f"Bilinmeyen model: {model}") from None
+
+    def __contains__(self, model: str) -> bool:
+        return model in self._providers
+
+    def __iter__(self):
+        return iter(self._providers.values())
+
+    def _chain(self, model: str) -> List[ImageProvider]:
+        """Модель и её запасные, без отключённых предохранителем"""
+        chain = [self.get(model)] + [
+            self._providers[name] for name in Config.IMAGE_FALLBACKS.get(model, [])
+            if name in self._providers
+        ]
+        return [provider for provider in chain if provider.breaker.available()]
+
+    async def generate(self, model: str, prompt: str) -> Tuple[ImageProvider, ImageResult]:
+        """Генерация с переключением на запасные модели.
+
+        Ошибка или отказ модели - сразу следующая по списку. Если модель
+        с hedge_after не ответила за это время, следующая запускается
+        параллельно и побеждает первый успешный ответ. Цена для
+        пользователя - как у выбранной модели.
+        """
+        primary = self.get(model)
+        candidates = self._chain(model)
+        if not candidates:
+            raise Unavailable(f"{model}: tüm modeller devre dışı")
+
+        tasks: Dict[asyncio.Task, ImageProvider] = {}
+        errors: List[str] = []
+
+        def launch() -> ImageProvider:
+            provider = candidates[len(tasks) + len(errors)]
+            tasks[asyncio.ensure_future(provider.generate(prompt))] = provider
+            return provider
+
+        current = launch()
+        try:
+            while tasks:
+                has_next = len(tasks) + len(errors) < len(candidates)
+                done, _ = await asyncio.wait(
+                    tasks, timeout=current.hedge_after if has_next else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    current = launch()
+                    logger.info(f"⏱ {model} yavaş, paralel deneniyor: {current.model}")
+                    continue
+
+                for task in done:
+                    provider = tasks.pop(task)
+                    if task.exception() is None:
+                        if provider is not primary:
+                            logger.info(f"🔀 {model} yerine {provider.model} kullanıldı")
+                        return provider, task.result()._replace(tokens=primary.price)
+                    errors.append(f"{provider.model}: {task.exception()!r}")
+
+                if not tasks and len(errors) < len(candidates):
+                    current = launch()
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise ProviderError("; ".join(errors))
+
+    async def close(self):
+        await self.pool.close()
+
+def build_registry(base_url: Optional[str] = None,
+                   api_key: Optional[str] = None) -> ProviderRegistry:
+    """Реестр по Config.IMAGE_PROVIDERS: HTTP-адаптеры при base_url, иначе демо"""
+    registry = ProviderRegistry(HTTPPool(max_connections=Config.HTTP_POOL_SIZE))
+    for model, settings in Config.IMAGE_PROVIDERS.items():
+        if base_url:
+            registry.register(HTTPProvider(model, base_url=base_url,
+                                           pool=registry.pool, api_key=api_key,
+                                           **settings))
+        else:
+            registry.register(DemoProvider(model, **settings))
+
+    for provider in registry:
+        metrics.PROVIDER_LIMIT.set_function(
+            lambda provider=provider: int(provider.limiter.limit), provider.model)
+        metrics.PROVIDER_CIRCUIT_OPEN.set_function(
+            lambda provider=provider: int(provider.breaker.state != CircuitBreaker.CLOSED),
+            provider.model)
+    return registry
+
+# Глобальный инстанс
+providers = build_registry(os.getenv("IMAGE_API_URL"), os.getenv("IMAGE_API_KEY"))
@@ -0,0 +1,87 @@
+# rate_limit.py - ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "notified")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.notified = 0.0
+
+    def consume(self, cost: float, now: float) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+class RateLimiter:
+    """Пользовательские и глобальная корзины токенов.
+
+    limits: {тип обработчика: (токенов в секунду, размер корзины)}.
+    Проверка - O(1). Корзины хранятся в порядке последнего обращения,
+    поэтому простаивающие вытесняются с начала словаря за O(1).
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]],
+                 global_limit: Optional[Tuple[float, float]] = None,
+                 idle_ttl: float = 600, max_buckets: int = 100000,
+                 notify_interval: float = 10):
+        self.limits = limits
+        self.idle_ttl = idle_ttl
+        self.max_buckets = max_buckets
+        self.notify_interval = notify_interval
+        self.rejected = 0
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._global = TokenBucket(*global_limit, time.monotonic()) if global_limit else None
+
+    def check(self, user_id: int, kind: str, cost: float = 1) -> bool:
+        """Разрешить ли обработку апдейта (и списать cost токенов)"""
+        rate, capacity = self.limits.get(kind, self.limits["default"])
+        now = time.monotonic()
+        key = (user_id, kind)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, capacity, now)
+        else:
+            self._buckets.move_to_end(key)
+        self._evict(now)
+
+        # Запрос дороже корзины всё равно должен когда-то пройти
+        cost = min(cost, capacity)
+        if not bucket.consume(cost, now):
+            self.rejected += 1
+            return False
+        if self._global is not None and not self._global.consume(1, now):
+            # Пользователь не виноват в общей перегрузке - возвращаем токены
+            bucket.tokens += cost
+            self.rejected += 1
+            return False
+        return True
+
+    def should_notify(self, user_id: int, kind: str) -> bool:
+        """Сообщать об ограничении не чаще раза в notify_interval секунд"""
+        bucket = self._buckets.get((user_id, kind))
+        now = time.monotonic()
+        if bucket is None or now - bucket.notified < self.notify_interval:
+            return False
+        bucket.notified = now
+        return True
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, oldest = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_buckets and now - oldest.updated < self.idle_ttl:
+                break
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -0,0 +1,136 @@
+# resilience.py - АДАПТИВНЫЕ ЛИМИТЫ И ПРЕДОХРАНИТЕЛИ ДЛЯ ВНЕШНИХ API
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class Unavailable(Exception):
+    """Бэкенд отклонил запрос сразу: предохранитель открыт или лимит занят"""
+
+class AdaptiveLimiter:
+    """Лимит одновременных запросов по AIMD.
+
+    Успешный ответ быстрее latency_target увеличивает лимит примерно
+    на 1 за "окно" из limit запросов (аддитивно); ошибка или медленный
+    ответ умножает его на backoff (мультипликативно), не чаще раза
+    в cooldown секунд - одна волна ошибок не обнуляет лимит.
+    Запрос, не получивший слот за max_wait, отклоняется (Unavailable).
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, initial: Optional[int] = None,
+                 latency_target: float = 10.0, backoff: float = 0.5,
+                 cooldown: float = 1.0, max_wait: float = 1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial or max_limit)
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        """async with limiter.slot(): ... - время и исход запроса меняют лимит"""
+        async with self._condition:
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self.in_flight < int(self.limit)),
+                    self.max_wait
+                )
+            except asyncio.TimeoutError:
+                raise Unavailable(f"limit {int(self.limit)} dolu") from None
+            self.in_flight += 1
+
+        started = time.monotonic()
+        # None - запрос отменён (проиграл хедж): лимит не меняется
+        outcome = None
+        try:
+            yield
+            outcome = time.monotonic() - started <= self.latency_target
+        except Exception:
+            outcome = False
+            raise
+        finally:
+            self._adjust(outcome)
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def _adjust(self, ok: Optional[bool]):
+        if ok is None:
+            return
+        if ok:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            return
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+
+class CircuitBreaker:
+    """Предохранитель: после failures ошибок подряд - отказ без запроса.
+
+    Через reset_timeout пропускает один пробный запрос (half-open):
+    успех закрывает предохранитель, ошибка снова открывает его.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failures: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос (в half-open - только один пробный)"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def available(self) -> bool:
+        """allow() без побочных эффектов - для выбора маршрута"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return not self._probe_in_flight
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"✅ 🔌 {self.name} yeniden erişilebilir")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failures:
+            if self.state != self.OPEN:
+                logger.warning(f"⚠️ 🔌 {self.name} devre dışı ({self.reset_timeout:.0f} sn)")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def record_cancel(self):
+        """Пробный запрос отменён (проиграл хедж) - разрешить новую пробу"""
+        self._probe_in_flight = False
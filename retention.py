@@ -0,0 +1,235 @@
+# retention.py - ХРАНЕНИЕ И АРХИВ ЖУРНАЛОВ
+"""Горячие таблицы transactions/images держат только последние месяцы.
+
+    transactions            - текущий месяц (горячая таблица, сюда пишет бот)
+    transactions_202609     - помесячные разделы (таблицы в той же базе)
+    transactions_all        - представление: горячая таблица + разделы
+    archive/transactions/2026-09.idx.json      - индекс архива месяца
+    archive/transactions/2026-09.<n>.jsonl.gz  - строки месяца, JSONL
+
+Архив - последовательность gzip-блоков, по одному на пользователя
+(строки отсортированы по user_id, id); индекс хранит смещение и длину
+блока каждого пользователя, поэтому поиск читает один блок, а не весь
+файл. Файл целиком по-прежнему читается zcat/gzip.open.
+
+RetentionJob периодически переносит строки старше горячего окна в
+разделы, архивирует разделы старше окна разделов и возвращает
+освободившееся место через incremental_vacuum.
+"""
+import os
+import io
+import json
+import gzip
+import time
+import heapq
+import asyncio
+import logging
+import functools
+import itertools
+import tempfile
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+
+from database import LEDGERS, PARTITION_TABLE, PARTITION_ARCHIVING
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx.json"
+
+def month_start(moment: datetime, shift: int = 0) -> str:
+    """Первый день месяца со сдвигом на shift месяцев: 'YYYY-MM-01'"""
+    index = moment.year * 12 + moment.month - 1 + shift
+    return f"{index // 12:04d}-{index % 12 + 1:02d}-01"
+
+def _row_key(row: dict):
+    return row["user_id"] if row["user_id"] is not None else -1, row["id"]
+
+def _unique(rows: Iterable[dict]) -> Iterator[dict]:
+    """Без повторов id: строки раздела, уже попавшие в архив, при слиянии идут подряд"""
+    last = None
+    for row in rows:
+        key = _row_key(row)
+        if key != last:
+            yield row
+        last = key
+
+# ========== АРХИВ ==========
+class LedgerArchive:
+    def __init__(self, root: str):
+        self.root = root
+
+    def index_path(self, source: str, month: str) -> str:
+        return os.path.join(self.root, source, month + INDEX_SUFFIX)
+
+    def _load_index(self, index_path: str) -> Optional[dict]:
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _iter_file(self, index: dict) -> Iterator[dict]:
+        """Все строки архива по порядку (user_id, id)"""
+        data_path = os.path.join(os.path.dirname(index["path"]), index["data"])
+        with gzip.open(data_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def data_name(self, month: str) -> str:
+        """Имя нового файла данных месяца (у каждой записи своё)"""
+        return f"{month}.{time.time_ns()}.jsonl.gz"
+
+    def is_written(self, source: str, month: str, data_name: str) -> bool:
+        """Индекс месяца уже указывает на файл data_name - запись завершена"""
+        index = self._load_index(self.index_path(source, month))
+        return index is not None and index["data"] == data_name
+
+    def write(self, source: str, month: str, rows: Iterable[dict],
+              data_name: Optional[str] = None) -> str:
+        """Записать строки месяца (по порядку user_id, id); возвращает путь индекса.
+
+        Если месяц уже в архиве (запоздавшие строки или повтор после сбоя),
+        старый архив сливается с новыми строками, повторяющиеся id
+        пишутся один раз. Точка фиксации - атомарная замена индекса;
+        прежний файл данных удаляется после неё.
+        """
+        directory = os.path.join(self.root, source)
+        os.makedirs(directory, exist_ok=True)
+        index_path = self.index_path(source, month)
+        previous = self._load_index(index_path)
+        if previous is not None:
+            previous["path"] = index_path
+            rows = _unique(heapq.merge(rows, self._iter_file(previous), key=_row_key))
+
+        data_name = data_name or self.data_name(month)
+        data_path = os.path.join(directory, data_name)
+        users = {}
+        total = 0
+        try:
+            with open(data_path, "wb") as f:
+                for user_id, group in itertools.groupby(rows, key=lambda row: row["user_id"]):
+                    block = io.BytesIO()
+                    count = 0
+                    with gzip.GzipFile(fileobj=block, mode="wb") as member:
+                        for row in group:
+                            member.write((json.dumps(row, ensure_ascii=False) + "\n").encode())
+                            count += 1
+                    offset = f.tell()
+                    f.write(block.getvalue())
+                    users[str(user_id)] = [offset, f.tell() - offset, count]
+                    total += count
+                f.flush()
+                os.fsync(f.fileno())
+
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"source": source, "month": month, "data": data_name,
+                           "rows": total, "users": users}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            if os.path.exists(data_path):
+                os.remove(data_path)
+            raise
+
+        if previous is not None and previous["data"] != data_name:
+            try:
+                os.remove(os.path.join(directory, previous["data"]))
+            except FileNotFoundError:
+                pass
+        logger.info(f"📦 Arşiv yazıldı: {source} {month} - {total} kayıt, {len(users)} kullanıcı")
+        return index_path
+
+    def months(self, source: str) -> List[str]:
+        directory = os.path.join(self.root, source)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name[:-len(INDEX_SUFFIX)] for name in os.listdir(directory)
+                      if name.endswith(INDEX_SUFFIX))
+
+    def lookup(self, source: str, user_id: int,
+               months: Optional[List[str]] = None) -> List[dict]:
+        """Архивные строки пользователя (по одному gzip-блоку на месяц), от новых к старым"""
+        found = []
+        for month in sorted(months or self.months(source), reverse=True):
+            index_path = self.index_path(source, month)
+            index = self._load_index(index_path)
+            entry = index and index["users"].get(str(user_id))
+            if not entry:
+                continue
+            offset, length, _ = entry
+            with open(os.path.join(os.path.dirname(index_path), index["data"]), "rb") as f:
+                f.seek(offset)
+                block = gzip.decompress(f.read(length))
+            rows = [json.loads(line) for line in block.decode("utf-8").splitlines()]
+            found.extend(reversed(rows))
+        return found
+
+# ========== ФОНОВАЯ ЗАДАЧА ==========
+class RetentionJob:
+    def __init__(self, db, archive: LedgerArchive, interval: float = 3600.0,
+                 hot_months: int = 1, table_months: int = 2,
+                 batch_size: int = 5000, vacuum_pages: int = 2000):
+        self.db = db
+        self.archive = archive
+        self.interval = interval
+        # Месяцев в горячей таблице (1 - только текущий) и в таблицах-разделах
+        self.hot_months = hot_months
+        self.table_months = table_months
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self, now: Optional[datetime] = None):
+        now = now or datetime.utcnow()
+        hot_cutoff = month_start(now, -(self.hot_months - 1))
+        archive_before = month_start(now, -(self.hot_months - 1 + self.table_months))[:7]
+
+        for source in LEDGERS:
+            while await self.db.partition_ledger(source, hot_cutoff, self.batch_size) >= self.batch_size:
+                pass
+
+        for partition in await self.db.get_partitions():
+            if (partition["state"] in (PARTITION_TABLE, PARTITION_ARCHIVING)
+                    and partition["month"] < archive_before):
+                await self._archive(partition["source"], partition["month"])
+
+        await self.db.incremental_vacuum(self.vacuum_pages)
+
+    async def _archive(self, source: str, month: str):
+        """Записать раздел в архив и удалить таблицу.
+
+        Попытка (имя файла данных) запоминается в ledger_partitions до записи:
+        если процесс упал после замены индекса, повторный проход только
+        удаляет таблицу, а не сливает месяц с архивом ещё раз.
+        """
+        data_name = await self.db.begin_archive(source, month, self.archive.data_name(month))
+        if data_name is None:
+            return
+        if await asyncio.to_thread(self.archive.is_written, source, month, data_name):
+            index_path = self.archive.index_path(source, month)
+        else:
+            index_path = await self.db.stream_partition(
+                source, month,
+                functools.partial(self.archive.write, source, month, data_name=data_name)
+            )
+        await self.db.drop_partition(source, month, index_path, data_name)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"❌ Arşiv görevi hatası: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name="retention")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,208 @@
+# scheduler.py - ОЧЕРЕДЬ ГЕНЕРАЦИЙ
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    """Очередь (общая или пользователя) переполнена"""
+
+class Job:
+    """Одна задача генерации в очереди"""
+    __slots__ = ("user_id", "run", "on_position", "on_cancel", "future", "position")
+
+    def __init__(self, user_id: int, run: Callable[[], Awaitable],
+                 on_position: Optional[Callable[[int], Awaitable]],
+                 on_cancel: Optional[Callable[[], Awaitable]] = None):
+        self.user_id = user_id
+        self.run = run
+        self.on_position = on_position
+        # Задача не выполнится или прервана (остановка бота) - например, вернуть токены
+        self.on_cancel = on_cancel
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.position: Optional[int] = None
+
+class GenerationScheduler:
+    """Ограниченная очередь генераций с пулом воркеров.
+
+    - общий лимит очереди (max_queue) и лимит ожидающих задач на пользователя;
+    - не больше per_user_limit задач пользователя выполняются одновременно;
+    - задачи берутся по кругу (round-robin) между пользователями, поэтому
+      один пользователь с десятком промптов не блокирует остальных;
+    - при изменении места в очереди вызывается on_position(позиция),
+      0 - задача, которая ждала в очереди, начала выполняться;
+    - при остановке ожидающие и выполняющиеся задачи отменяются,
+      для каждой вызывается on_cancel().
+    """
+
+    def __init__(self, workers: int = 4, max_queue: int = 100,
+                 per_user_limit: int = 1, per_user_queue: int = 5):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_user_limit = per_user_limit
+        self.per_user_queue = per_user_queue
+
+        self._queues: "OrderedDict[int, Deque[Job]]" = OrderedDict()
+        self._inflight: Dict[int, int] = {}
+        self._size = 0
+        self._changed = asyncio.Event()
+        self._notify_pending = False
+        self._workers: Set[asyncio.Task] = set()
+        self._callbacks: Set[asyncio.Task] = set()
+
+    # ========== СОСТОЯНИЕ ==========
+    @property
+    def queued(self) -> int:
+        """Сколько задач ждёт в очереди"""
+        return self._size
+
+    @property
+    def in_flight(self) -> int:
+        """Сколько задач выполняется сейчас"""
+        return sum(self._inflight.values())
+
+    # ========== ЗАПУСК / ОСТАНОВКА ==========
+    async def start(self):
+        for i in range(self.workers):
+            task = asyncio.create_task(self._worker(), name=f"gen-worker-{i}")
+            self._workers.add(task)
+        logger.info(f"✅ Üretim kuyruğu başlatıldı: {self.workers} işçi")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+        # Ожидающие задачи уже не выполнятся
+        cancelled = [job for queue in self._queues.values() for job in queue]
+        self._queues.clear()
+        self._size = 0
+        for job in cancelled:
+            job.future.cancel()
+        await asyncio.gather(*(self._cancel(job) for job in cancelled))
+
+    # ========== ПОСТАНОВКА В ОЧЕРЕДЬ ==========
+    def submit(self, user_id: int, run: Callable[[], Awaitable],
+               on_position: Optional[Callable[[int], Awaitable]] = None,
+               on_cancel: Optional[Callable[[], Awaitable]] = None) -> asyncio.Future:
+        """Поставить задачу в очередь; вернуть future с её результатом"""
+        if self._size >= self.max_queue:
+            raise QueueFullError("queue is full")
+
+        queue = self._queues.get(user_id)
+        if queue is not None and len(queue) >= self.per_user_queue:
+            raise QueueFullError("user queue is full")
+
+        job = Job(user_id, run, on_position, on_cancel)
+        # Результат может никто не ждать - не ругаемся на неполученные ошибки
+        job.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+        queue.append(job)
+        self._size += 1
+
+        self._changed.set()
+        self._schedule_notify()
+        return job.future
+
+    # ========== ВНУТРЕННЕЕ ==========
+    def _pop_runnable(self) -> Optional[Job]:
+        """Следующая задача по кругу среди пользователей без превышения лимита"""
+        for user_id in list(self._queues):
+            if self._inflight.get(user_id, 0) >= self.per_user_limit:
+                continue
+
+            queue = self._queues.pop(user_id)
+            job = queue.popleft()
+            if queue:
+                # Пользователь уходит в конец круга
+                self._queues[user_id] = queue
+            self._size -= 1
+            self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+            return job
+        return None
+
+    def _schedule_notify(self):
+        """Пересчитать места после того, как свободные воркеры разберут задачи.
+
+        Откладываем через call_soon: разбуженные воркеры успеют забрать
+        задачи, и тем, кто сразу начал выполняться, место не отправляется.
+        """
+        if not self._notify_pending:
+            self._notify_pending = True
+            asyncio.get_running_loop().call_soon(self._notify_positions)
+
+    def _notify_positions(self):
+        """Пересчитать места в очереди и сообщить об изменившихся.
+
+        Задача с индексом k в очереди пользователя уйдёт в k-м круге;
+        перед ней - по k задач (k+1, если пользователь раньше в круге)
+        от каждого другого пользователя.
+        """
+        self._notify_pending = False
+        lengths = [(user_id, len(queue)) for user_id, queue in self._queues.items()]
+        for index, (user_id, _) in enumerate(lengths):
+            for k, job in enumerate(self._queues[user_id]):
+                position = 1 + k
+                for other_index, (other_id, other_len) in enumerate(lengths):
+                    if other_id == user_id:
+                        continue
+                    rounds = k + 1 if other_index < index else k
+                    position += min(other_len, rounds)
+                self._report(job, position)
+
+    def _report(self, job: Job, position: int):
+        if job.on_position is None or job.position == position:
+            return
+        job.position = position
+        task = asyncio.create_task(self._call_position(job, position))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    async def _call_position(self, job: Job, position: int):
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            logger.warning(f"⚠️ Sıra bildirimi gönderilemedi: {e}")
+
+    async def _cancel(self, job: Job):
+        if job.on_cancel is None:
+            return
+        try:
+            await job.on_cancel()
+        except Exception as e:
+            logger.error(f"❌ İptal edilen görev kapatılamadı: {e}")
+
+    async def _worker(self):
+        while True:
+            job = self._pop_runnable()
+            if job is None:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+
+            self._schedule_notify()
+            if job.position:
+                # Задача ждала в очереди - сообщаем о начале выполнения
+                self._report(job, 0)
+            try:
+                result = await job.run()
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                await self._cancel(job)
+                raise
+            except Exception as e:
+                logger.error(f"❌ Üretim görevi hatası: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._inflight[job.user_id] -= 1
+                if not self._inflight[job.user_id]:
+                    del self._inflight[job.user_id]
+                self._changed.set()
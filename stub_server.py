@@ -0,0 +1,77 @@
+# stub_server.py - ЛОКАЛЬНЫЙ API ИЗОБРАЖЕНИЙ ДЛЯ ПРОВЕРКИ
+"""Заглушка API провайдеров (providers.HTTPProvider) без внешних сервисов.
+
+    python stub_server.py --port 8090 --latency-ms 800 --error-rate 0.05
+    IMAGE_API_URL=http://127.0.0.1:8090 python bot.py
+
+POST /v1/images {"model", "prompt"} -> {"url"}: детерминированная
+картинка picsum.photos по хэшу промпта, после искусственной задержки.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 latency: float, error_rate: float):
+    # keep-alive: несколько запросов на одном соединении
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip())
+            body = await reader.readexactly(length) if length else b""
+
+            parts = request_line.split()
+            if len(parts) < 2 or parts[0] != b"POST" or parts[1] != b"/v1/images":
+                status, payload = "404 Not Found", {"error": "not found"}
+            else:
+                await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+                request = json.loads(body or b"{}")
+                if random.random() < error_rate:
+                    status, payload = "503 Service Unavailable", {"error": "overloaded"}
+                else:
+                    seed = hashlib.md5(
+                        f"{request.get('model')}:{request.get('prompt')}".encode()
+                    ).hexdigest()[:12]
+                    status, payload = "200 OK", {"url": f"https://picsum.photos/seed/{seed}/512/512"}
+
+            data = json.dumps(payload).encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def main():
+    parser = argparse.ArgumentParser(description="Local image API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = await asyncio.start_server(
+        lambda r, w: handle(r, w, args.latency_ms / 1000, args.error_rate),
+        args.host, args.port
+    )
+    print(f"Stub image API: http://{args.host}:{args.port}/v1/images")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,224 @@
+# tracing.py - ТРАССИРОВКА МЕДЛЕННЫХ АПДЕЙТОВ И ПРОФИЛИРОВЩИК
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional, Tuple
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Этапы обработки апдейта
+SQLITE = "sqlite"
+GENERATOR = "generator"
+TELEGRAM = "telegram"
+DOWNLOAD = "download"
+# Всё, что не попало в спаны: форматирование текстов, клавиатуры, логика обработчика
+OTHER = "other"
+
+class Trace:
+    """Спаны одного апдейта: суммарное время и число вызовов по этапам"""
+    __slots__ = ("label", "update_id", "started", "elapsed", "stages")
+
+    def __init__(self, label: str, update_id: Optional[int]):
+        self.label = label
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.stages: Dict[str, List[float]] = {}
+
+    def add(self, stage: str, seconds: float):
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [seconds, 1]
+        else:
+            totals[0] += seconds
+            totals[1] += 1
+
+    def breakdown(self) -> List[Tuple[str, float, int]]:
+        """(этап, секунды, вызовов) по убыванию времени, с остатком в OTHER.
+
+        Параллельные спаны (gather) складываются, поэтому сумма этапов
+        может превышать общее время - тогда OTHER не показывается.
+        """
+        rows = [(stage, total, int(count)) for stage, (total, count) in self.stages.items()]
+        other = self.elapsed - sum(total for _, total, _ in rows)
+        if other > 0:
+            rows.append((OTHER, other, 0))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows
+
+    def format(self) -> str:
+        parts = [
+            f"{stage}={total * 1000:.1f}ms" + (f"/{count}" if count else "")
+            for stage, total, count in self.breakdown()
+        ]
+        return (f"{self.label} (update {self.update_id}) {self.elapsed * 1000:.1f}ms: "
+                + ", ".join(parts))
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+class Tracer:
+    """Трассировка апдейтов: медленные (дольше threshold) пишутся в лог"""
+
+    def __init__(self, threshold: float = 1.0, enabled: bool = True, keep: int = 20):
+        self.threshold = threshold
+        self.enabled = enabled
+        # Последние медленные апдейты для команды /debug
+        self.slow: Deque[Trace] = deque(maxlen=keep)
+
+    @contextmanager
+    def trace(self, label: str, update_id: Optional[int] = None):
+        """Трасса на время блока; вложенные вызовы попадают в уже открытую"""
+        if not self.enabled or _current.get() is not None:
+            yield
+            return
+
+        current = Trace(label, update_id)
+        token = _current.set(current)
+        try:
+            yield
+        finally:
+            _current.reset(token)
+            current.elapsed = time.perf_counter() - current.started
+            if current.elapsed >= self.threshold:
+                self.slow.append(current)
+                logger.warning(f"🐢 Yavaş güncelleme: {current.format()}")
+
+    @contextmanager
+    def span(self, stage: str):
+        """Замер этапа внутри текущей трассы (вне трассы ничего не делает)"""
+        current = _current.get()
+        if current is None:
+            yield
+            return
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            current.add(stage, time.perf_counter() - started)
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest, время запросов к Bot API которого идёт в спан TELEGRAM"""
+
+    async def do_request(self, *args, **kwargs):
+        with tracer.span(TELEGRAM):
+            return await super().do_request(*args, **kwargs)
+
+# ========== ПРОФИЛИРОВЩИК ==========
+class SamplingProfiler:
+    """Сэмплирующий профилировщик: раз в interval снимает стеки всех потоков.
+
+    Результат - collapsed stacks ("поток;модуль:функция;... N"),
+    из которых flamegraph.pl или speedscope строят flame graph.
+    """
+
+    def __init__(self, interval: float = 0.005, output_dir: str = "profiles"):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.samples: Counter = Counter()
+        self.started: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.samples = Counter()
+        self.started = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"✅ 🔬 Profil başladı (her {self.interval * 1000:.0f}ms)")
+
+    def stop(self) -> Optional[str]:
+        """Остановить и записать файл; возвращает путь к нему"""
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir,
+            time.strftime("profile-%Y%m%d-%H%M%S.folded", time.localtime(self.started))
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"✅ 🔬 Profil kaydedildi: {path} ({sum(self.samples.values())} örnek)")
+        return path
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self.samples[self._collapse(names.get(ident, str(ident)), frame)] += 1
+
+    @staticmethod
+    def _collapse(thread_name: str, frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            stack.append(f"{module}:{code.co_name}")
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ";".join(reversed(stack))
+
+# ========== ВРЕМЯ СТАРТА ==========
+def _process_age() -> float:
+    """Сколько секунд назад запущен процесс (Linux /proc; иначе 0)"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+class StartupTimer:
+    """Время от запуска процесса до этапов старта (import, build, init, first_update)"""
+
+    def __init__(self):
+        # Отсчёт от старта процесса, а не от импорта модуля: так в отчёт
+        # попадает и запуск интерпретатора, и импорт telegram/httpx
+        self.started = time.perf_counter() - _process_age()
+        self.marks: Dict[str, float] = {}
+
+    def mark(self, stage: str) -> bool:
+        """Отметить этап; False если он уже отмечен"""
+        if stage in self.marks:
+            return False
+        self.marks[stage] = time.perf_counter() - self.started
+        return True
+
+    def format(self) -> str:
+        return ", ".join(f"{stage}={seconds * 1000:.0f}ms"
+                         for stage, seconds in self.marks.items())
+
+# Глобальные экземпляры
+startup = StartupTimer()
+tracer = Tracer(
+    threshold=float(os.getenv("SLOW_UPDATE_MS", "1000")) / 1000,
+    enabled=os.getenv("TRACING", "1") != "0"
+)
+profiler = SamplingProfiler(
+    interval=float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000,
+    output_dir=os.getenv("PROFILE_DIR", "profiles")
+)